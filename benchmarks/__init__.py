@@ -0,0 +1,3 @@
+"""Performance benchmarks, run each one as a module from the repository root,
+for instance `python -m benchmarks.index_storage`.
+"""
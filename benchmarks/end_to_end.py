@@ -0,0 +1,167 @@
+"""Time clone, pull, push, sync, mv and rm against a fake Imgur server, on
+synthetic albums, and append the results to a JSON lines file so that runs
+can be compared.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import time
+
+from imgit import actions
+from imgit import client
+from imgit import journal
+from imgit import models
+from imgit import storage
+from imgit import utils
+
+from .fake_imgur import FakeImgur
+
+
+# Resumes of a step before giving up on it
+MAX_RESUMES = 20
+
+
+def write_credentials(folder: pathlib.Path) -> tuple[pathlib.Path, pathlib.Path]:
+    credentials_path = folder / "credentials.json"
+    token_path = folder / "token.json"
+    utils.write_dataclass(client.Credentials("bench", "id", "secret", "http://localhost"), credentials_path)
+    utils.write_dataclass(client.Token("token", "3600", "bearer", "refresh", "bench", "0"), token_path)
+    return credentials_path, token_path
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide the output of actions, progress bars included."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def timed(results: dict, name: str, server: FakeImgur, imgur: client.Client, root: pathlib.Path, jobs: int, function):
+    """Time a step, then resume it until its journal is empty, as a user would
+    after the errors the server injects.
+    """
+    requests_before = sum(server.requests.values())
+    failures = 0
+    resumes = 0
+    start = time.perf_counter()
+    with quiet():
+        try:
+            function()
+        except (models.ImgurError, models.ImgitError):
+            failures += 1
+        while journal.Journal(root).pending() and resumes < MAX_RESUMES:
+            resumes += 1
+            try:
+                actions.resume(imgur, root, jobs=jobs)
+            except (models.ImgurError, models.ImgitError):
+                failures += 1
+    results[name] = {
+        "seconds": time.perf_counter() - start,
+        "requests": sum(server.requests.values()) - requests_before,
+        "failures": failures,
+        "resumes": resumes,
+        "pending": len(journal.Journal(root).pending()),
+    }
+
+
+def benchmark(size: int, args: argparse.Namespace, folder: pathlib.Path) -> dict[str, dict]:
+    server = FakeImgur(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        quota_rate=args.quota_rate,
+        user_limit=10 ** 9,
+        client_limit=10 ** 9,
+        post_limit=10 ** 9).start()
+    try:
+        album_id = server.seed_album(size, args.image_size)
+        credentials_path, token_path = write_credentials(folder)
+        imgur = client.Client(
+            credentials_path,
+            token_path,
+            wait_on_quota=True,
+            pool_size=max(10, args.jobs),
+            api_url=server.url)
+        root = folder / f"album-{size}"
+        changed = max(1, size // 10)
+        results = {}
+        utils.confirm = lambda message: True
+        timed(results, "clone", server, imgur, root, args.jobs, lambda: actions.clone(imgur, f"https://imgur.com/a/{album_id}", root, args.jobs))
+        paths = sorted(actions.load_index(root))
+        for path in paths[:changed]:
+            (root / path).unlink()
+        timed(results, "pull", server, imgur, root, args.jobs, lambda: actions.pull(imgur, root, jobs=args.jobs))
+        (root / "new").mkdir()
+        for i in range(changed):
+            (root / "new" / f"new{i:06d}.jpg").write_bytes(os.urandom(args.image_size))
+        timed(results, "push", server, imgur, root, args.jobs, lambda: actions.push(imgur, root, jobs=args.jobs))
+        for path in paths[changed:2 * changed]:
+            (root / path).unlink()
+        for i in range(changed):
+            (root / "new" / f"sync{i:06d}.jpg").write_bytes(os.urandom(args.image_size))
+        timed(results, "sync", server, imgur, root, args.jobs, lambda: actions.sync(imgur, root, jobs=args.jobs))
+        timed(results, "mv", server, imgur, root, args.jobs, lambda: actions.mv(imgur, pathlib.Path("new"), pathlib.Path("moved"), root, jobs=args.jobs))
+        timed(results, "rm", server, imgur, root, args.jobs, lambda: actions.rm(imgur, "moved", True, root, jobs=args.jobs))
+        storage.open_store(root).close()
+        shutil.rmtree(root)
+        return results
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("sizes", type=int, nargs="*", default=[100, 1000], help="Number of images of the synthetic albums")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Number of concurrent operations")
+    parser.add_argument("-s", "--image-size", type=int, default=16 * 1024, help="Size of each image in bytes")
+    parser.add_argument("-l", "--latency", type=float, default=0.005, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Probability of a 500 answer")
+    parser.add_argument("--quota-rate", type=float, default=0, help="Probability of a 429 answer")
+    parser.add_argument("-o", "--output", type=pathlib.Path, default=pathlib.Path("benchmarks") / "results" / "end_to_end.jsonl", help="File the results are appended to")
+    args = parser.parse_args()
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            rows.append((size, benchmark(size, args, pathlib.Path(folder))))
+    names = list(rows[0][1].keys())
+    print(f"{'images':>8} " + " ".join(f"{name:>16}" for name in names))
+    for size, results in rows:
+        print(f"{size:>8} " + " ".join(f"{results[name]['seconds']:>8.2f}s {results[name]['requests']:>5}r" for name in names))
+        failed = {name: result for name, result in results.items() if result["failures"] or result["resumes"] or result["pending"]}
+        for name, result in failed.items():
+            print(f"{'':>8} {name}: {result['failures']} failure(s), {result['resumes']} resume(s), {result['pending']} operation(s) left pending")
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "a", encoding="utf8") as file:
+        for size, results in rows:
+            file.write(json.dumps({
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "images": size,
+                "jobs": args.jobs,
+                "image_size": args.image_size,
+                "latency": args.latency,
+                "error_rate": args.error_rate,
+                "quota_rate": args.quota_rate,
+                "results": results,
+            }) + "\n")
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""In-process stand-in for the Imgur API endpoints used by imgit.Client, to
+benchmark and test synchronization without a network or an API quota.
+"""
+
+import email.parser
+import email.policy
+import http.server
+import json
+import random
+import re
+import string
+import threading
+import time
+import urllib.parse
+
+
+CHUNK_SIZE = 64 * 1024 # bytes
+
+
+def random_id(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=7))
+
+
+def synthetic_content(image_id: str, size: int, offset: int = 0, length: int | None = None):
+    """Yield the deterministic content of a synthetic image by chunks, without
+    holding it in memory.
+    """
+    pattern = (image_id.encode() * (CHUNK_SIZE // len(image_id) + 2))[:CHUNK_SIZE]
+    end = size if length is None else min(size, offset + length)
+    position = offset
+    while position < end:
+        start = position % CHUNK_SIZE
+        chunk = pattern[start:start + min(CHUNK_SIZE - start, end - position)]
+        yield chunk
+        position += len(chunk)
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict[str, bytes | str]:
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True)
+        fields[name] = payload if part.get_filename() else payload.decode("utf8")
+    return fields
+
+
+class FakeImgurHandler(http.server.BaseHTTPRequestHandler):
+
+    server: "FakeImgur"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def read_fields(self, body: bytes) -> dict:
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            return parse_multipart(content_type, body)
+        return {key: values if key.endswith("[]") else values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    def send_json(self, code: int, body: dict, headers: dict[str, str] | None = None):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_api(self, method: str):
+        body = self.read_body() if method == "POST" else b""
+        server = self.server
+        post = method == "POST"
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests[method] = server.requests.get(method, 0) + 1
+            injected = server.inject(post)
+            headers = server.rate_limit_headers(post)
+        if injected == 429:
+            if all(self.server.remaining[name] > 0 for name in ["user", "client"]):
+                headers["X-RateLimit-UserRemaining"] = "0"
+                headers["X-RateLimit-UserReset"] = str(int(time.time()) + 1)
+            self.send_json(429, {"data": {"error": "Too Many Requests"}, "success": False, "status": 429}, headers)
+            return
+        if injected is not None:
+            self.send_json(injected, {"data": {"error": "Internal error"}, "success": False, "status": injected}, headers)
+            return
+        path = urllib.parse.urlparse(self.path).path
+        for pattern, route_method, function in server.routes:
+            m = re.fullmatch(pattern, path)
+            if m is not None and route_method == method:
+                fields = self.read_fields(body) if body else {}
+                with server.lock:
+                    code, data = function(*m.groups(), **({"fields": fields} if post else {}))
+                if code == 200:
+                    self.send_json(200, {"data": data, "success": True, "status": 200}, headers)
+                else:
+                    self.send_json(code, {"errors": [{"code": code, "status": "Error", "detail": data}]}, headers)
+                return
+        self.send_json(404, {"errors": [{"code": 404, "status": "Not Found", "detail": path}]}, headers)
+
+    def do_GET(self):
+        if self.path.startswith("/media/"):
+            self.send_media()
+        else:
+            self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def send_media(self):
+        image_id = self.path[7:].split(".")[0]
+        with self.server.lock:
+            image = self.server.images.get(image_id)
+            self.server.requests["MEDIA"] = self.server.requests.get("MEDIA", 0) + 1
+        if image is None:
+            self.send_json(404, {"errors": [{"code": 404, "status": "Not Found", "detail": image_id}]})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(image["size"]))
+        self.end_headers()
+        if image["content"] is not None:
+            self.wfile.write(image["content"])
+        else:
+            for chunk in synthetic_content(image_id, image["size"]):
+                self.wfile.write(chunk)
+
+
+class FakeImgur(http.server.ThreadingHTTPServer):
+    """Imgur API served from memory, on a background thread.
+
+    latency is added to every request. The rate limit headers count down from
+    the given limits, and a 429 is answered once a budget is spent, until the
+    budgets reset every reset_period seconds. error_rate is the probability of
+    answering a 500 and quota_rate the one of answering a 429 regardless of
+    the budgets, as if the user budget ran out for a second. Seeded images are synthetic,
+    their content is generated when downloaded.
+    """
+
+    def __init__(self,
+            port: int = 0,
+            latency: float = 0,
+            user_limit: int = 12500,
+            client_limit: int = 12500,
+            post_limit: int = 1250,
+            error_rate: float = 0,
+            quota_rate: float = 0,
+            reset_period: float = 3600,
+            seed: int = 0):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), FakeImgurHandler)
+        self.latency = latency
+        self.limits = {"user": user_limit, "client": client_limit, "post": post_limit}
+        self.remaining = dict(self.limits)
+        self.reset_period = reset_period
+        self.reset_at = time.time() + reset_period
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.albums: dict[str, dict] = {}
+        self.images: dict[str, dict] = {}
+        self.requests: dict[str, int] = {}
+        self.thread: threading.Thread | None = None
+        self.routes = [
+            (r"/3/album", "POST", self.create_album),
+            (r"/3/album/(\w+)", "GET", self.get_album),
+            (r"/3/album/(\w+)/images", "GET", self.get_album_images),
+            (r"/3/album/(\w+)/remove_images", "POST", self.remove_album_images),
+            (r"/3/upload", "POST", self.upload),
+            (r"/3/image/(\w+)", "DELETE", self.delete_image),
+            (r"/3/image/(\w+)", "POST", self.update_image),
+        ]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeImgur":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def inject(self, post: bool) -> int | None:
+        """Spend the budgets of a request, and return the error status to
+        answer instead of handling it, if any.
+        """
+        if time.time() >= self.reset_at:
+            self.remaining = dict(self.limits)
+            self.reset_at = time.time() + self.reset_period
+        for name in ["user", "client"] + (["post"] if post else []):
+            if self.remaining[name] <= 0:
+                return 429
+            self.remaining[name] -= 1
+        if self.quota_rate and self.rng.random() < self.quota_rate:
+            return 429
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return 500
+        return None
+
+    def rate_limit_headers(self, post: bool) -> dict[str, str]:
+        reset = int(self.reset_at)
+        headers = {
+            "X-RateLimit-UserLimit": str(self.limits["user"]),
+            "X-RateLimit-UserRemaining": str(self.remaining["user"]),
+            "X-RateLimit-UserReset": str(reset),
+            "X-RateLimit-ClientLimit": str(self.limits["client"]),
+            "X-RateLimit-ClientRemaining": str(self.remaining["client"]),
+        }
+        if post:
+            headers.update({
+                "X-Post-Rate-Limit-Limit": str(self.limits["post"]),
+                "X-Post-Rate-Limit-Remaining": str(self.remaining["post"]),
+                "X-Post-Rate-Limit-Reset": str(int(self.reset_at - time.time())),
+            })
+        return headers
+
+    def new_album(self, title: str) -> str:
+        album_id = random_id(self.rng)
+        self.albums[album_id] = {
+            "id": album_id,
+            "deletehash": random_id(self.rng),
+            "title": title,
+            "description": "",
+            "datetime": int(time.time()),
+            "link": f"{self.url}/a/{album_id}",
+            "images": [],
+        }
+        return album_id
+
+    def new_image(self, album_id: str | None, description: str, size: int, content: bytes | None = None) -> dict:
+        image_id = random_id(self.rng)
+        self.images[image_id] = {
+            "id": image_id,
+            "deletehash": random_id(self.rng),
+            "title": description,
+            "description": description,
+            "datetime": int(time.time()),
+            "size": size,
+            "link": f"{self.url}/media/{image_id}.jpg",
+            "content": content,
+        }
+        if album_id is not None:
+            self.albums[album_id]["images"].append(image_id)
+        return self.images[image_id]
+
+    def seed_album(self, count: int, size: int = 1024, folder_size: int = 1000, title: str = "album") -> str:
+        """Create an album of count synthetic images, spread in folders, and
+        return its id.
+        """
+        with self.lock:
+            album_id = self.new_album(title)
+            for i in range(count):
+                self.new_image(album_id, f"folder{i // folder_size:03d}/image{i:06d}.jpg", size)
+        return album_id
+
+    def image_json(self, image: dict) -> dict:
+        return {key: value for key, value in image.items() if key != "content"}
+
+    def create_album(self, fields: dict):
+        return 200, {"id": self.new_album(fields.get("title", "")), "deletehash": ""}
+
+    def get_album(self, album_id: str):
+        if album_id not in self.albums:
+            return 404, f"Album {album_id} not found"
+        album = self.albums[album_id]
+        return 200, {**{k: v for k, v in album.items() if k != "images"}, "images_count": len(album["images"])}
+
+    def get_album_images(self, album_id: str):
+        if album_id not in self.albums:
+            return 404, f"Album {album_id} not found"
+        return 200, [self.image_json(self.images[image_id]) for image_id in self.albums[album_id]["images"]]
+
+    def remove_album_images(self, album_id: str, fields: dict):
+        if album_id not in self.albums:
+            return 404, f"Album {album_id} not found"
+        ids = set(fields.get("ids[]", []))
+        self.albums[album_id]["images"] = [image_id for image_id in self.albums[album_id]["images"] if image_id not in ids]
+        return 200, True
+
+    def upload(self, fields: dict):
+        album_id = fields.get("album")
+        if album_id is not None and album_id not in self.albums:
+            return 404, f"Album {album_id} not found"
+        content = fields["image"]
+        image = self.new_image(album_id, fields.get("description", ""), len(content), content)
+        return 200, self.image_json(image)
+
+    def delete_image(self, image_id: str):
+        if self.images.pop(image_id, None) is None:
+            return 404, f"Image {image_id} not found"
+        for album in self.albums.values():
+            if image_id in album["images"]:
+                album["images"].remove(image_id)
+        return 200, True
+
+    def update_image(self, image_id: str, fields: dict):
+        if image_id not in self.images:
+            return 404, f"Image {image_id} not found"
+        for key in ["title", "description"]:
+            if key in fields:
+                self.images[image_id][key] = fields[key]
+        return 200, True
@@ -0,0 +1,74 @@
+"""Compare load and save times of the JSON and SQLite index storages.
+"""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+from imgit import models
+from imgit import storage
+from imgit import utils
+
+
+def synthetic_index(size: int) -> models.Index:
+    return models.Index.from_list([
+        models.Image(
+            path=f"folder{i // 1000:03d}/image{i:06d}.jpg",
+            remote_id=f"{i:07d}",
+            remote_datetime=1700000000 + i,
+            remote_size=1024 * 1024,
+            remote_delete_hash=f"deletehash{i:06d}",
+            remote_link=f"https://i.imgur.com/{i:07d}.jpg",
+            local_size=1024 * 1024,
+            local_ctime=1700000000.5 + i,
+            local_mtime=1700000000.5 + i,
+            local_md5=f"{i:032x}",
+            local_inode=i,
+            local_hash_algorithm="blake2b",
+        )
+        for i in range(size)
+    ])
+
+
+def timeit(function, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(size: int, folder: pathlib.Path) -> dict[str, float]:
+    index = synthetic_index(size)
+    image = next(iter(index.values()))
+    json_path = folder / f"index-{size}.json"
+    store = storage.IndexStore(folder / f"index-{size}.db")
+    results = {
+        "json save": timeit(lambda: utils.write_dataclass_list(list(index.values()), json_path)),
+        "json load": timeit(lambda: models.Index.from_list(utils.read_dataclass_list(models.Image, json_path))),
+        # Checkpointing one image with JSON means rewriting the whole file
+        "json checkpoint": timeit(lambda: utils.write_dataclass_list(list(index.values()), json_path)),
+        "sqlite save": timeit(lambda: store.save(index)),
+        "sqlite load": timeit(store.load),
+        "sqlite checkpoint": timeit(lambda: store.upsert([image])),
+    }
+    store.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("sizes", type=int, nargs="*", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        rows = [(size, benchmark(size, pathlib.Path(folder))) for size in args.sizes]
+    names = list(rows[0][1].keys())
+    print(f"{'entries':>8} " + " ".join(f"{name:>17}" for name in names))
+    for size, results in rows:
+        print(f"{size:>8} " + " ".join(f"{results[name] * 1000:>15.2f}ms" for name in names))
+
+
+if __name__ == "__main__":
+    main()
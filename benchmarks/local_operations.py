@@ -0,0 +1,195 @@
+"""Time the local, CPU and disk bound operations of imgit on synthetic folder
+trees: scanning, hashing, diffing, index input/output and the removal of empty
+folders. Throughput and peak Python memory are printed and appended to a JSON
+lines file so that runs can be compared.
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import datetime
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from imgit import actions
+from imgit import models
+from imgit import storage
+from imgit import utils
+
+from .end_to_end import git_revision
+
+
+def write_album(root: pathlib.Path):
+    (root / models.IMGIT_FOLDER).mkdir(parents=True, exist_ok=True)
+    album = models.Album(id="0000000", delete_hash="", title=root.name, description="", datetime=0, link="")
+    utils.write_dataclass(album, root / models.IMGIT_FOLDER / "meta.json")
+
+
+def make_small_files(root: pathlib.Path, count: int, size: int = 4096, per_folder: int = 200):
+    for i in range(count):
+        folder = root / f"folder{i // per_folder:04d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"image{i:06d}.jpg").write_bytes(i.to_bytes(4, "big") * (size // 4))
+
+
+def make_large_files(root: pathlib.Path, count: int, size: int):
+    block = os.urandom(1024 * 1024)
+    for i in range(count):
+        with open(root / f"video{i}.mp4", "wb") as file:
+            for _ in range(size // len(block)):
+                file.write(block)
+
+
+def make_deep_tree(root: pathlib.Path, depth: int, width: int, files: int):
+    folders = [root]
+    for level in range(depth):
+        folders = [folder / f"level{level}-{j}" for folder in folders[:width] for j in range(2)]
+        for folder in folders:
+            folder.mkdir(parents=True, exist_ok=True)
+            for k in range(files):
+                (folder / f"image{k}.jpg").write_bytes(os.urandom(256))
+
+
+def make_ignore_file(root: pathlib.Path, count: int):
+    patterns = []
+    for i in range(count):
+        patterns.append([f"*.tmp{i}", f"folder{i:04d}/private/", f"**/cache{i}/**", f"!keep{i}.jpg"][i % 4])
+    (root / models.IGNORE_NAME).write_text("\n".join(patterns) + "\n", encoding="utf8")
+
+
+def make_empty_folders(root: pathlib.Path, count: int):
+    for i in range(count):
+        folder = root / f"empty{i // 100:03d}" / f"sub{i % 100:03d}" / "leaf"
+        folder.mkdir(parents=True, exist_ok=True)
+        if i % 10 == 0:
+            (folder / "kept.jpg").write_bytes(b"")
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(name: str, function, files: int = 0, size: int = 0, setup=None) -> dict:
+    """Time one run of function, then run it again while tracing Python
+    allocations for the peak memory, as tracing slows it down.
+    """
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    with quiet():
+        function()
+    seconds = time.perf_counter() - start
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    with quiet():
+        function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "name": name,
+        "seconds": seconds,
+        "files": files,
+        "files_per_second": files / seconds if files else None,
+        "megabytes_per_second": size / 1024 ** 2 / seconds if size else None,
+        "peak_memory_megabytes": peak / 1024 ** 2,
+    }
+
+
+def tree_size(index: models.Index) -> int:
+    return sum(image.local_size for image in index.values())
+
+
+def benchmark_tree(name: str, root: pathlib.Path, algorithm: str) -> list[dict]:
+    """Scan and hash a tree cold and warm, then diff it against an index where
+    every file is synced, and time the index input/output.
+    """
+    results = []
+    with quiet():
+        local_index = actions.build_local_index(root, algorithm=algorithm)
+    files, size = len(local_index), tree_size(local_index)
+    results.append(measure(f"{name}: scan and hash", lambda: actions.build_local_index(root, algorithm=algorithm), files, size))
+    results.append(measure(f"{name}: scan, cached", lambda: actions.build_local_index(root, local_index, algorithm=algorithm), files))
+    index = models.Index.from_list([
+        dataclasses.replace(image, remote_id=f"{i:07d}", remote_link=f"https://i.imgur.com/{i:07d}.jpg", remote_size=image.local_size, remote_datetime=0, remote_delete_hash="")
+        for i, image in enumerate(local_index.values())
+    ])
+    results.append(measure(f"{name}: write index", lambda: actions.write_index(root, index), files))
+    results.append(measure(f"{name}: load index", lambda: actions.load_index(root), files))
+    results.append(measure(f"{name}: diff", lambda: actions.diff(root, algorithm=algorithm), files))
+    return results
+
+
+def benchmark_hash(folder: pathlib.Path, size: int) -> list[dict]:
+    path = folder / "hash.bin"
+    make_large_files(folder, 1, size)
+    (folder / "video0.mp4").rename(path)
+    results = [
+        measure(f"hash_file {algorithm}", lambda: utils.hash_file(path, algorithm), 1, size)
+        for algorithm in utils.HASH_ALGORITHMS
+    ]
+    path.unlink()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--small-files", type=int, default=20000, help="Number of small JPEG files")
+    parser.add_argument("-l", "--large-files", type=int, default=4, help="Number of large MP4 files")
+    parser.add_argument("-s", "--large-size", type=int, default=64, help="Size of each large file in MB")
+    parser.add_argument("-d", "--depth", type=int, default=12, help="Depth of the nested tree")
+    parser.add_argument("-p", "--patterns", type=int, default=500, help="Number of .imgitignore patterns")
+    parser.add_argument("-e", "--empty-folders", type=int, default=5000, help="Number of empty folders to remove")
+    parser.add_argument("--hash", type=str, default=utils.DEFAULT_HASH_ALGORITHM, choices=utils.HASH_ALGORITHMS, help="Algorithm for hashing local files")
+    parser.add_argument("-o", "--output", type=pathlib.Path, default=pathlib.Path("benchmarks") / "results" / "local_operations.jsonl", help="File the results are appended to")
+    args = parser.parse_args()
+    large_size = args.large_size * 1024 * 1024
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder = pathlib.Path(folder)
+        trees = {
+            "small files": lambda root: make_small_files(root, args.small_files),
+            "large files": lambda root: make_large_files(root, args.large_files, large_size),
+            "deep tree": lambda root: make_deep_tree(root, args.depth, 64, 2),
+            "ignore rules": lambda root: (make_small_files(root, args.small_files), make_ignore_file(root, args.patterns)),
+        }
+        for name, make in trees.items():
+            root = folder / name.replace(" ", "-")
+            write_album(root)
+            make(root)
+            results += benchmark_tree(name, root, args.hash)
+            storage.open_store(root).close()
+            shutil.rmtree(root)
+        results += benchmark_hash(folder, large_size)
+        root = folder / "empty-folders"
+        results.append(measure(
+            "remove_empty_directories",
+            lambda: utils.remove_empty_directories(root),
+            args.empty_folders,
+            setup=lambda: make_empty_folders(root, args.empty_folders)))
+    width = max(len(result["name"]) for result in results)
+    print(f"{'benchmark':<{width}} {'time':>9} {'files/s':>10} {'MB/s':>8} {'peak MB':>8}")
+    for result in results:
+        files_per_second = "" if result["files_per_second"] is None else f"{result['files_per_second']:.0f}"
+        megabytes_per_second = "" if result["megabytes_per_second"] is None else f"{result['megabytes_per_second']:.0f}"
+        print(f"{result['name']:<{width}} {result['seconds']:>8.3f}s {files_per_second:>10} {megabytes_per_second:>8} {result['peak_memory_megabytes']:>8.1f}")
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "a", encoding="utf8") as file:
+        file.write(json.dumps({
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "parameters": {key: str(value) for key, value in vars(args).items()},
+            "results": results,
+        }) + "\n")
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Time the startup of `imgit status` on a small album, compared to a bare
+interpreter, and check that it does not import the dependencies only network
+actions and the GUI need. Exits with an error when the overhead exceeds the
+budget, so it can guard against import regressions.
+"""
+
+import argparse
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .local_operations import make_small_files, write_album
+
+
+REPOSITORY = pathlib.Path(__file__).parent.parent
+HEAVY_MODULES = ["requests", "urllib3", "tqdm", "jinja2", "watchdog", "http.server", "webbrowser"]
+STATUS_SCRIPT = f"""
+import sys
+sys.argv = ["imgit", "status"]
+import imgit
+imgit.main()
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+if heavy:
+    sys.exit("Imported " + ", ".join(heavy))
+"""
+
+
+def run(code: str, cwd: pathlib.Path, repeat: int) -> list[float]:
+    env = {**os.environ, "PYTHONPATH": str(REPOSITORY)}
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, capture_output=True, text=True)
+        durations.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip())
+    return durations
+
+
+def slowest_imports(cwd: pathlib.Path, count: int) -> list[tuple[int, str]]:
+    env = {**os.environ, "PYTHONPATH": str(REPOSITORY)}
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", STATUS_SCRIPT], cwd=cwd, env=env, capture_output=True, text=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip().startswith("imgit"):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="Number of runs, the median is kept")
+    parser.add_argument("-n", "--files", type=int, default=100, help="Number of files of the album")
+    parser.add_argument("-b", "--budget", type=float, default=150, help="Maximum startup overhead over a bare interpreter, in milliseconds")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        root = pathlib.Path(folder)
+        write_album(root)
+        make_small_files(root, args.files)
+        run(STATUS_SCRIPT, root, 1)
+        bare = statistics.median(run("pass", root, args.repeat))
+        status = statistics.median(run(STATUS_SCRIPT, root, args.repeat))
+        imports = slowest_imports(root, 5)
+    overhead = (status - bare) * 1000
+    print(f"bare interpreter  {bare * 1000:>7.1f}ms")
+    print(f"imgit status      {status * 1000:>7.1f}ms")
+    print(f"overhead          {overhead:>7.1f}ms (budget {args.budget:.0f}ms)")
+    print("slowest imgit modules, cumulative import time:")
+    for microseconds, name in imports:
+        print(f"  {name:<16} {microseconds / 1000:>7.1f}ms")
+    if overhead > args.budget:
+        sys.exit(f"imgit status startup overhead {overhead:.1f}ms exceeds the budget of {args.budget:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
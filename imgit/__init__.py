@@ -4,67 +4,193 @@
 import argparse
 import pathlib
 
-from .client import Client
 from . import actions
+from . import daemon
 from . import utils
 from . import models
+from . import profiling
 
 
 base_dir = pathlib.Path(__file__).parent.parent
+# Actions that do not talk to Imgur, for which the client and its
+# dependencies are not even imported
+LOCAL_ACTIONS = ["status", "gui"]
+# Options of the client, that a daemon was started with its own values of
+CLIENT_OPTIONS = ["credentials", "token", "api_url", "timeout", "retries", "pool_size", "wait"]
+
+
+def daemon_arguments(args: argparse.Namespace) -> dict:
+    """Arguments of the action to forward to the daemon, as JSON values."""
+    if args.action == "status":
+        return {"rehash": args.rehash, "algorithm": args.hash}
+    if args.action == "fetch":
+        return {"quick": args.quick}
+    arguments = {"rehash": args.rehash, "algorithm": args.hash, "jobs": args.jobs}
+    if args.action == "push":
+        arguments["skip_duplicates"] = args.skip_duplicates
+        arguments["dedup_with"] = None if args.dedup_with is None else str(args.dedup_with.resolve())
+    return arguments
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-c", "--credentials", type=pathlib.Path, default=base_dir / "credentials.json")
     parser.add_argument("-t", "--token", type=pathlib.Path, default=pathlib.Path.home() / ".config" / "imgit" / "token.json")
+    parser.add_argument("--api-url", type=str, default=models.API_URL, help="Base URL of the Imgur API")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout in seconds for each network read")
+    parser.add_argument("--retries", type=int, default=3, help="Retries on connection errors and server errors")
+    parser.add_argument("--pool-size", type=int, default=10, help="Number of kept-alive connections")
+    parser.add_argument("--wait", action="store_true", help="When the API quota is reached, wait for it to reset instead of stopping")
+    parser.add_argument("--rehash", action="store_true", help="Ignore the stat cache and hash every local file again")
+    parser.add_argument("--profile", action="store_true", help="Print the time spent in each phase of the action")
+    parser.add_argument("--profile-trace", type=pathlib.Path, default=None, help="Write the timed phases to this file, in the Chrome trace JSON format")
+    parser.add_argument("--cprofile", type=pathlib.Path, default=None, help="Run under cProfile and write its stats to this file")
+    parser.add_argument("--no-daemon", action="store_true", help="Run the action in this process even if a daemon serves the album")
+    parser.add_argument("--hash", type=str, default=utils.DEFAULT_HASH_ALGORITHM, choices=utils.HASH_ALGORITHMS, help="Algorithm for hashing local files, xxh3 is the fastest and needs the xxhash package")
     actions_parser = parser.add_subparsers(dest="action", help="Action to perform")
     init = actions_parser.add_parser("init", help="Initialize a new album with current folder")
     init.add_argument("url", type=str, help="URL of an already existing album", nargs="?")
     clone = actions_parser.add_parser("clone", help="Clone an album to a local folder")
     clone.add_argument("url", type=str, help="URL of the album to clone")
     clone.add_argument("folder", type=str, help="Local folder to clone the album to", nargs="?")
+    clone.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent downloads")
     actions_parser.add_parser("status", help="Print album details")
-    actions_parser.add_parser("fetch", help="Fetch album index")
-    actions_parser.add_parser("pull", help="Download images")
-    actions_parser.add_parser("push", help="Upload images and apply changes")
-    actions_parser.add_parser("sync", help="Pull and push")
-    actions_parser.add_parser("remove", help="Remove online photos that do not exist locally")
+    fetch = actions_parser.add_parser("fetch", help="Fetch album index")
+    fetch.add_argument("--quick", action="store_true", help="Skip the listing if the image count did not change, which misses replaced and renamed images")
+    pull = actions_parser.add_parser("pull", help="Download images")
+    pull.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent downloads")
+    push = actions_parser.add_parser("push", help="Upload images and apply changes")
+    push.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent uploads")
+    push.add_argument("--skip-duplicates", action="store_true", help="Do not upload files whose content is already online")
+    push.add_argument("--dedup-with", type=pathlib.Path, default=None, help="Also look for duplicates in the albums below this folder")
+    sync = actions_parser.add_parser("sync", help="Pull and push")
+    sync.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent downloads and uploads")
+    sync.add_argument("-r", "--recursive", type=pathlib.Path, default=None, help="Sync every album found below this folder")
+    sync.add_argument("--skip-duplicates", action="store_true", help="Do not upload files whose content is already online")
+    sync.add_argument("--dedup-with", type=pathlib.Path, default=None, help="Also look for duplicates in the albums below this folder")
+    sync.add_argument("-a", "--albums", type=int, default=1, help="Number of albums synced concurrently with --recursive")
+    resume = actions_parser.add_parser("resume", help="Resume an interrupted action")
+    resume.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent operations")
+    remove = actions_parser.add_parser("remove", help="Remove online photos that do not exist locally")
+    remove.add_argument("-j", "--jobs", type=int, default=4, help="Number of concurrent API calls")
+    remove.add_argument("--detach", action="store_true", help="Only remove the photos from the album, in batches, instead of deleting them")
     rm = actions_parser.add_parser("rm", help="Remove a file")
     rm.add_argument("pattern", type=str, help="Image(s) to remove, supports glob pattern")
     rm.add_argument("-f", "--force", action="store_true", help="Do not ask for confirmation")
+    rm.add_argument("-j", "--jobs", type=int, default=4, help="Number of concurrent API calls")
     mv = actions_parser.add_parser("mv", help="Rename a file or a folder")
     mv.add_argument("src", type=pathlib.Path, help="Source path")
     mv.add_argument("dst", type=pathlib.Path, help="Destination path")
+    mv.add_argument("-j", "--jobs", type=int, default=4, help="Number of concurrent API calls")
+    watch = actions_parser.add_parser("watch", help="Continuously push local changes and pull remote ones")
+    watch.add_argument("-j", "--jobs", type=int, default=1, help="Number of concurrent operations")
+    watch.add_argument("--debounce", type=float, default=2, help="Seconds without changes before syncing them")
+    watch.add_argument("--fetch-interval", type=float, default=300, help="Seconds between two remote fetches")
+    watch.add_argument("--poll", action="store_true", help="Poll the folder instead of using filesystem events")
+    watch.add_argument("--poll-interval", type=float, default=5, help="Seconds between two polls")
+    watch.add_argument("--delete", action="store_true", help="Delete online the images whose file is deleted locally, instead of downloading them again")
     gui_parser = actions_parser.add_parser("gui", help="Open GUI with a local server")
     gui_parser.add_argument("host", type=str, default="127.0.0.1:8000", help="Hostname for the local server", nargs="?")
+    gui_parser.add_argument("--live", action="store_true", help="Update the page when the index changes, after a sync for instance")
+    daemon_parser = actions_parser.add_parser("daemon", help="Serve status, fetch, pull and push from a process keeping the album in memory")
+    daemon_parser.add_argument("--stop", action="store_true", help="Stop the daemon of the album")
     args = parser.parse_args()
+    profiling.PROFILER.enabled = args.profile or args.profile_trace is not None
+    cprofile = None
+    if args.cprofile is not None:
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
     try:
-        client = Client(args.credentials)
+        client_options = [name for name in CLIENT_OPTIONS if getattr(args, name) != parser.get_default(name)]
+        if args.action in daemon.DAEMON_ACTIONS\
+                and not (args.no_daemon or profiling.PROFILER.enabled or cprofile is not None)\
+                and (args.action in LOCAL_ACTIONS or not client_options)\
+                and daemon.request(pathlib.Path("."), args.action, daemon_arguments(args)):
+            return
+        if args.action == "daemon" and args.stop:
+            daemon.stop()
+            return
+        client = None
+        if args.action not in LOCAL_ACTIONS:
+            from .client import Client
+            client = Client(
+                args.credentials,
+                args.token,
+                wait_on_quota=args.wait,
+                pool_size=args.pool_size,
+                retries=args.retries,
+                timeout=args.timeout,
+                api_url=args.api_url)
         if args.action == "init":
             actions.init(client, args.url)
         elif args.action == "clone":
-            actions.clone(client, args.url, args.folder)
+            actions.clone(client, args.url, args.folder, args.jobs)
         elif args.action == "status":
-            actions.status()
+            actions.status(rehash=args.rehash, algorithm=args.hash)
         elif args.action == "fetch":
-            actions.fetch(client)
+            actions.fetch(client, quick=args.quick)
         elif args.action == "pull":
-            actions.pull(client)
+            actions.pull(client, rehash=args.rehash, algorithm=args.hash, jobs=args.jobs)
         elif args.action == "push":
-            actions.push(client)
+            actions.push(
+                client,
+                rehash=args.rehash,
+                algorithm=args.hash,
+                jobs=args.jobs,
+                skip_duplicates=args.skip_duplicates,
+                dedup_roots=None if args.dedup_with is None else actions.find_roots(args.dedup_with))
+        elif args.action == "sync" and args.recursive is not None:
+            actions.sync_recursive(
+                client,
+                args.recursive,
+                args.rehash,
+                args.hash,
+                args.jobs,
+                args.albums,
+                skip_duplicates=args.skip_duplicates,
+                dedup_roots=None if args.dedup_with is None else actions.find_roots(args.dedup_with))
         elif args.action == "sync":
-            actions.sync(client)
+            actions.sync(
+                client,
+                rehash=args.rehash,
+                algorithm=args.hash,
+                jobs=args.jobs,
+                skip_duplicates=args.skip_duplicates,
+                dedup_roots=None if args.dedup_with is None else actions.find_roots(args.dedup_with))
+        elif args.action == "resume":
+            actions.resume(client, algorithm=args.hash, jobs=args.jobs)
         elif args.action == "rm":
-            actions.rm(client, args.pattern, args.force)
+            actions.rm(client, args.pattern, args.force, jobs=args.jobs)
         elif args.action == "mv":
-            actions.mv(client, args.src, args.dst)
+            actions.mv(client, args.src, args.dst, jobs=args.jobs)
         elif args.action == "remove":
-            actions.remove(client)
+            actions.remove(client, rehash=args.rehash, algorithm=args.hash, jobs=args.jobs, detach=args.detach)
+        elif args.action == "watch":
+            actions.watch(
+                client,
+                algorithm=args.hash,
+                jobs=args.jobs,
+                debounce=args.debounce,
+                fetch_interval=args.fetch_interval,
+                poll=args.poll,
+                poll_interval=args.poll_interval,
+                delete=args.delete)
         elif args.action == "gui":
-            actions.gui(args.host)
+            actions.gui(args.host, live=args.live)
+        elif args.action == "daemon":
+            daemon.serve(client)
     except models.QuotaError as err:
         utils.printc("Error: " + str(err), "yellow")
     except models.ImgurError as err:
         utils.printc("Error: " + str(err), "red")
     except models.ImgitError as err:
-        utils.printc("Error: " + str(err), "red")
\ No newline at end of file
+        utils.printc("Error: " + str(err), "red")
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(args.cprofile)
+        if profiling.PROFILER.enabled:
+            print(profiling.PROFILER.summary())
+        if args.profile_trace is not None:
+            profiling.PROFILER.write_trace(args.profile_trace)
\ No newline at end of file
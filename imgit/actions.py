@@ -1,17 +1,29 @@
-import fnmatch
+# Heavy dependencies (requests, tqdm, jinja2, watchdog) are imported by the
+# actions that need them, so that local commands such as status start fast.
+from __future__ import annotations
+
+import collections
+import dataclasses
 import glob
 import os
 import pathlib
 import re
 import shutil
-import webbrowser
-
-import tqdm
+import threading
+import time
+import typing
 
-from .client import Client
+from . import ignore
+from . import journal
 from . import models
+from . import profiling
+from . import storage
 from . import utils
-from .gui import GuiServer
+
+if typing.TYPE_CHECKING:
+    import tqdm
+    from .client import Client
+    from . import watching
 
 
 def extract_album_id(url: str) -> str | None:
@@ -24,7 +36,7 @@ def extract_album_id(url: str) -> str | None:
     return None
 
 
-def clone(client: Client, url: str, folder: str | None = None):
+def clone(client: Client, url: str, folder: str | None = None, jobs: int = 1):
     album_id = extract_album_id(url)
     if album_id is None:
         raise models.ImgitError(f"Could not extract album id from {url}")
@@ -39,7 +51,7 @@ def clone(client: Client, url: str, folder: str | None = None):
     (path / models.IMGIT_FOLDER).mkdir(parents=True, exist_ok=True)
     utils.write_dataclass(album, path / models.IMGIT_FOLDER / "meta.json")
     fetch(client, path)
-    pull(client, path)
+    pull(client, path, jobs=jobs)
 
 
 def load_album(root: pathlib.Path) -> models.Album:
@@ -50,241 +62,705 @@ def load_album(root: pathlib.Path) -> models.Album:
 
 
 def load_index(root: pathlib.Path) -> models.Index:
-    path = root / models.IMGIT_FOLDER / "index.json"
-    if not path.parent.exists():
-        raise models.ImgitError("Not an imgit folder")
-    if not path.exists():
-        return models.Index()
-    images = utils.read_dataclass_list(models.Image, path)
-    return models.Index.from_list(images)
+    return storage.open_store(root).load()
 
 
 def write_index(root: pathlib.Path, index: models.Index):
-    path = root / models.IMGIT_FOLDER / "index.json"
-    if not path.parent.exists():
-        raise models.ImgitError("Not an imgit folder")
-    utils.write_dataclass_list(list(index.values()), path)
+    storage.open_store(root).save(index)
 
 
-def status(root: pathlib.Path = pathlib.Path(".")):
-    album = load_album(root)
-    index = load_index(root)
-    download, link, upload, change, delete = diff(root)
-    print(f"{album.title} [{album.link}] #{len(index)}")
-    if not (download or link or upload or change or delete):
+def status(root: pathlib.Path = pathlib.Path("."),
+           rehash: bool = False,
+           algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+           plan: models.Plan | None = None):
+    if plan is None:
+        plan = diff(root, rehash, algorithm)
+    print(f"{plan.album.title} [{plan.album.link}] #{len(plan.index)}")
+    if plan.up_to_date:
         print("Up to date.")
-    for image in download:
+    for image in plan.download:
         utils.printc("↓ " + image.path, "cyan")
-    for image in link:
+    for image in plan.link:
         utils.printc("↔ " + image.path, "darkcyan")
-    for image in upload:
+    for indexed, local in plan.rename:
+        utils.printc(f"→ {indexed.path} → {local.path}", "purple")
+    for image in plan.upload:
         utils.printc("↑ " + image.path, "green")
-    for image in change:
+    for image in plan.change:
         utils.printc("~ " + image.path, "blue")
-    for image in delete:
+    for image in plan.delete:
         utils.printc("x " + image.path, "red")
 
 
-def fetch(client: Client, root: pathlib.Path = pathlib.Path(".")):
+REMOTE_FIELDS = ["remote_id", "remote_datetime", "remote_size", "remote_delete_hash", "remote_link"]
+
+
+def fetch(client: Client, root: pathlib.Path = pathlib.Path("."), quick: bool = False):
+    """Update the index with the album listing. With quick, the listing is
+    skipped when the image count did not change, which misses replaced and
+    renamed images.
+    """
     album = load_album(root)
     index = load_index(root)
+    start = time.time()
+    remote_album = client.get_album(album.id)
+    online = sum(1 for image in index.values() if image.online)
+    if quick\
+            and remote_album.images_count is not None\
+            and remote_album.images_count == album.images_count\
+            and remote_album.images_count == online:
+        # Imgur has no modification date for albums, an unchanged image count
+        # on both sides is the best hint that the listing did not change.
+        print(f"Fetch: image count unchanged ({time.time() - start:.2f}s), listing skipped")
+        return
     remote_index = client.get_album_images(album.id)
+    network = time.time() - start
+    start = time.time()
+    changed = []
+    deleted = []
     for image in remote_index.values():
-        if image.path in index:
-            index[image.path].remote_id = image.remote_id
-            index[image.path].remote_datetime = image.remote_datetime
-            index[image.path].remote_size = image.remote_size
-            index[image.path].remote_delete_hash = image.remote_delete_hash
-            index[image.path].remote_link = image.remote_link
-        else:
+        if image.path not in index:
             index.add(image)
+            changed.append(image)
+            continue
+        indexed = index[image.path]
+        if any(getattr(indexed, field) != getattr(image, field) for field in REMOTE_FIELDS):
+            for field in REMOTE_FIELDS:
+                setattr(indexed, field, getattr(image, field))
+            changed.append(indexed)
     for image in list(index.values()):
-        if image.path not in remote_index:
-            if not image.offline:
-                del index[image.path]
+        if image.path in remote_index or not image.online and image.offline:
+            continue
+        if not image.offline:
+            del index[image.path]
+            deleted.append(image.path)
+        else:
+            for field in REMOTE_FIELDS:
+                setattr(image, field, None)
+            changed.append(image)
+    store = storage.open_store(root)
+    store.delete(deleted)
+    store.upsert(changed)
+    utils.write_dataclass(remote_album, root / models.IMGIT_FOLDER / "meta.json")
+    merge = time.time() - start
+    print(f"Fetch: {len(remote_index)} images, {len(changed)} updated, {len(deleted)} removed"
+          f" (network {network:.2f}s, merge {merge:.2f}s)")
+
+
+def is_stat_cached(image: models.Image | None, stat: os.stat_result) -> bool:
+    return image is not None\
+        and image.local_md5 is not None\
+        and image.local_size == stat.st_size\
+        and image.local_mtime == stat.st_mtime\
+        and image.local_ctime == stat.st_ctime\
+        and image.local_inode == stat.st_ino
+
+
+def walk_local_files(root: pathlib.Path, rules: ignore.IgnoreRules, top: str = ""):
+    """Yield the paths, relative to root, of the accepted files below top that
+    are not ignored.
+    """
+    for folder, dirnames, filenames in os.walk(root / top):
+        folder = pathlib.Path(folder)
+        prefix = folder.relative_to(root).as_posix() + "/"
+        if prefix == "./":
+            prefix = ""
+            if models.IMGIT_FOLDER in dirnames:
+                dirnames.remove(models.IMGIT_FOLDER)
+        # Pruning ignored folders in place keeps os.walk from listing them
+        kept = []
+        for dirname in dirnames:
+            if rules.match(prefix + dirname, folder=True):
+                print("Ignored path:", folder / dirname)
             else:
-                index[image.path].remote_id = None
-                index[image.path].remote_datetime = None
-                index[image.path].remote_size = None
-                index[image.path].remote_delete_hash = None
-                index[image.path].remote_link = None
-    write_index(root, index)
-
-
-def load_ignore_patterns(path: str | pathlib.Path) -> list[str]:
-    with open(path, "r", encoding="utf8") as file:
-        patterns = [
-            line.strip()
-            for line in file
-            if line.strip() and not line.startswith('#')
-        ]
-    return patterns
+                kept.append(dirname)
+        dirnames[:] = kept
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in models.ACCEPTED_EXTENSIONS:
+                continue
+            if rules.match(prefix + filename):
+                print("Ignored path:", folder / filename)
+                continue
+            yield prefix + filename
 
 
-def is_ignored(path: str, ignore_patterns: list[str]) -> bool:
-    for pattern in ignore_patterns:
-        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
-            return True
-    return False
+def is_in_ignored_folder(relpath: str, rules: ignore.IgnoreRules) -> bool:
+    parts = relpath.split("/")
+    if parts[0] == models.IMGIT_FOLDER:
+        return True
+    return any(rules.match("/".join(parts[:i]), folder=True) for i in range(1, len(parts)))
 
 
-def build_local_index(root: pathlib.Path) -> models.Index:
+def select_local_files(root: pathlib.Path, rules: ignore.IgnoreRules, paths: set[str]):
+    """Same as walk_local_files, restricted to some paths and the content of
+    the folders among them.
+    """
+    for relpath in sorted(paths):
+        path = root / relpath
+        if is_in_ignored_folder(relpath, rules):
+            continue
+        if path.is_dir():
+            if not rules.match(relpath, folder=True):
+                yield from walk_local_files(root, rules, relpath)
+        elif path.is_file() and path.suffix in models.ACCEPTED_EXTENSIONS and not rules.match(relpath):
+            yield relpath
+
+
+def build_local_index(root: pathlib.Path,
+        cache: models.Index | None = None,
+        rehash: bool = False,
+        algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+        paths: set[str] | None = None) -> models.Index:
     imgit_path = root / models.IMGIT_FOLDER
     if not imgit_path.exists():
         raise models.ImgitError("Not an imgit folder")
     index = models.Index()
-    ignore_patterns = []
+    rules = ignore.IgnoreRules([])
     if (root / models.IGNORE_NAME).exists():
-        ignore_patterns = load_ignore_patterns(root / models.IGNORE_NAME)
-    for top, _, filenames in os.walk(root):
-        folder = pathlib.Path(top)
-        if folder.as_posix().startswith(imgit_path.as_posix()):
+        rules = ignore.IgnoreRules.from_file(root / models.IGNORE_NAME)
+    if paths is None:
+        relpaths = walk_local_files(root, rules)
+    else:
+        relpaths = select_local_files(root, rules, paths)
+    pending: list[models.Image] = []
+    scan_start = time.perf_counter()
+    for relpath in relpaths:
+        if relpath in index:
             continue
-        for filename in filenames:
-            path = folder / filename
-            if path.suffix not in models.ACCEPTED_EXTENSIONS:
-                continue
-            if is_ignored(path.as_posix(), ignore_patterns):
-                print("Ignored path:", path)
-                continue
-            md5 = utils.hash_file(path)
-            stat = path.stat()
-            index.add(models.Image(
-                path=path.relative_to(root).as_posix(),
-                local_size=stat.st_size,
-                local_ctime=stat.st_ctime,
-                local_mtime=stat.st_mtime,
-                local_md5=md5,
-                remote_id=None,
-                remote_datetime=None,
-                remote_size=None,
-                remote_delete_hash=None,
-                remote_link=None,
-            ))
+        try:
+            stat = (root / relpath).stat()
+        except FileNotFoundError:
+            continue
+        image = models.Image(
+            path=relpath,
+            local_size=stat.st_size,
+            local_ctime=stat.st_ctime,
+            local_mtime=stat.st_mtime,
+            local_md5=None,
+            local_inode=stat.st_ino,
+            remote_id=None,
+            remote_datetime=None,
+            remote_size=None,
+            remote_delete_hash=None,
+            remote_link=None,
+        )
+        cached_image = None if (cache is None or rehash) else cache.get(relpath)
+        if is_stat_cached(cached_image, stat):
+            image.local_md5 = cached_image.local_md5
+            image.local_hash_algorithm = cached_image.local_hash_algorithm
+        else:
+            pending.append(image)
+        index.add(image)
+    profiling.record("scan", scan_start, time.perf_counter() - scan_start)
+    profiling.count("files scanned", len(index))
+    profiling.count("bytes hashed", sum(image.local_size for image in pending))
+    with profiling.phase("hash"):
+        digests = utils.hash_files([root / image.path for image in pending], algorithm, missing_ok=True)
+    hashed = 0
+    for image, digest in zip(pending, digests):
+        if digest is None:
+            # Removed between the scan and the hash
+            del index[image.path]
+            continue
+        image.local_md5 = digest
+        image.local_hash_algorithm = algorithm
+        hashed += 1
+    if index:
+        print(f"Hashed {hashed} file(s), {len(index) - hashed} served from cache")
     return index
 
 
-def diff(root: pathlib.Path = pathlib.Path(".")
-         ) -> tuple[list[models.Image], list[models.Image], list[models.Image], list[models.Image], list[models.Image]]:
-    album = load_album(root)
-    index = load_index(root)
-    local_index = build_local_index(root)
-    download = []
-    for image in index.values():
-        if image.online and image.path not in local_index:
-            download.append(image)
-    link = []
-    for image in local_index.values():
-        if image.path in index and index[image.path].online and not index[image.path].offline:
-            link.append(image)
-    upload = []
-    for image in local_index.values():
-        if image.path not in index or not index[image.path].online:
-            upload.append(image)
-    change = []
-    for image in local_index.values():
-        if image.path in index and index[image.path].online and index[image.path].offline and index[image.path].local_md5 != image.local_md5:
-            change.append(image)
-    delete = []
-    for image in index.values():
-        if image.path not in local_index and not index[image.path].online:
-            delete.append(image)
-    return download, link, upload, change, delete
-
-
-def pull(client: Client, root: pathlib.Path = pathlib.Path(".")):
+def same_content(root: pathlib.Path, indexed: models.Image, local: models.Image) -> bool:
+    if indexed.local_hash_algorithm == local.local_hash_algorithm:
+        return indexed.local_md5 == local.local_md5
+    # Entry was hashed with another algorithm (e.g. the legacy partial MD5):
+    # compare with that one, the entry migrates the next time it is written.
+    algorithm = indexed.local_hash_algorithm or utils.LEGACY_HASH_ALGORITHM
+    if not utils.is_hash_available(algorithm):
+        hint = ", install the xxhash package to read it" if algorithm == "xxh3" else ""
+        raise models.ImgitError(f"The index was hashed with {algorithm}, which is not available{hint}")
+    return indexed.local_md5 == utils.hash_file(root / local.path, algorithm)
+
+
+def is_stat_refreshed(indexed: models.Image, local: models.Image) -> bool:
+    return indexed.local_size == local.local_size\
+        and indexed.local_mtime == local.local_mtime\
+        and indexed.local_ctime == local.local_ctime\
+        and indexed.local_inode == local.local_inode\
+        and indexed.local_hash_algorithm == local.local_hash_algorithm
+
+
+def diff(root: pathlib.Path = pathlib.Path("."),
+         rehash: bool = False,
+         algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+         paths: set[str] | None = None) -> models.Plan:
+    """Compare the index with the local folder. If paths is given, only these
+    paths, and the content of the folders among them, are compared.
+    """
     album = load_album(root)
     index = load_index(root)
-    download, link = diff(root)[:2]
-    if not (download or link):
-        print("Pull: already up to date.")
+    local_index = build_local_index(root, index, rehash, algorithm, paths)
+    plan = models.Plan(album, index, local_index)
+    keys = index.keys()
+    if paths is not None:
+        keys = {
+            path for path in index
+            if path in paths or any("/".join(path.split("/")[:i]) in paths for i in range(1, path.count("/") + 1))
+        }
+    refresh = []
+    diff_start = time.perf_counter()
+    for path in sorted(keys | local_index.keys()):
+        indexed = index.get(path)
+        local = local_index.get(path)
+        if local is None:
+            if indexed.online:
+                plan.download.append(indexed)
+            else:
+                plan.delete.append(indexed)
+        elif indexed is None or not indexed.online:
+            plan.upload.append(local)
+        elif not indexed.offline:
+            plan.link.append(local)
+        elif not same_content(root, indexed, local):
+            plan.change.append(local)
+        elif not is_stat_refreshed(indexed, local):
+            refresh.append(local)
+    find_renames(plan)
+    profiling.record("diff", diff_start, time.perf_counter() - diff_start)
+    # Like git refreshing its index on status: unchanged files that were touched
+    # get their new stat data and hash saved, so they hit the cache next time.
+    for local in refresh:
+        indexed = index[local.path]
+        indexed.local_size = local.local_size
+        indexed.local_ctime = local.local_ctime
+        indexed.local_mtime = local.local_mtime
+        indexed.local_md5 = local.local_md5
+        indexed.local_inode = local.local_inode
+        indexed.local_hash_algorithm = local.local_hash_algorithm
+    if refresh:
+        storage.open_store(root).upsert([index[local.path] for local in refresh])
+    return plan
+
+
+def find_renames(plan: models.Plan):
+    """Pair new local files with synced images that are missing locally and
+    have the same size and hash: they were moved outside of imgit, and only
+    need their online title updated instead of a delete and an upload.
+    """
+    missing: dict[tuple, list[models.Image]] = {}
+    for image in plan.download:
+        if image.offline:
+            missing.setdefault((image.local_hash_algorithm, image.local_md5, image.local_size), []).append(image)
+    if not missing:
         return
-    for image in link:
-        index[image.path].local_size = image.local_size
-        index[image.path].local_ctime = image.local_ctime
-        index[image.path].local_mtime = image.local_mtime
-        index[image.path].local_md5 = image.local_md5
-    pbar = tqdm.tqdm(total=len(download), unit="image")
-    for image in download:
-        path = root / image.path
-        pbar.set_description(path.name)
+    upload = []
+    for local in plan.upload:
+        candidates = missing.get((local.local_hash_algorithm, local.local_md5, local.local_size))
+        if candidates and local.path not in plan.index:
+            indexed = candidates.pop(0)
+            plan.download.remove(indexed)
+            plan.rename.append((indexed, local))
+        else:
+            upload.append(local)
+    plan.upload = upload
+
+
+OPERATION_SYMBOLS = {
+    "download": "↓",
+    "upload": "↑",
+    "replace": "↑",
+    "delete": "x",
+    "move": "→",
+    "detach": "x",
+}
+
+
+# Operations sent to Imgur as one request per batch, with the batch size
+BATCHED_OPERATIONS = {
+    "detach": 50,
+}
+# Operations sending a local file, whose bytes are shown as a second progress bar
+UPLOAD_OPERATIONS = ["upload", "replace"]
+
+
+class Operations:
+    """Run remote operations on a thread pool, journaling them and saving the
+    index after each one. Operations are plain dicts so that they can be
+    written to the journal and replayed by `resume`.
+
+    With keep_going, an operation that fails is reported and left pending in
+    the journal instead of stopping the others. The operations that succeeded
+    are counted by kind in `done`.
+    """
+
+    def __init__(self,
+            client: Client,
+            root: pathlib.Path,
+            index: models.Index,
+            algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+            jobs: int = 1,
+            keep_going: bool = False):
+        self.client = client
+        self.root = root
+        self.album = load_album(root)
+        self.index = index
+        self.algorithm = algorithm
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.failures: list[tuple[dict, Exception]] = []
+        self.done: collections.Counter[str] = collections.Counter()
+        self.journal = journal.Journal(root)
+        self.store = storage.open_store(root)
+        self.remote_index: models.Index | None = None
+        self._lock = threading.Lock()
+        self._pbar: tqdm.tqdm | None = None
+        self._bytes_pbar: tqdm.tqdm | None = None
+
+    def plan(self, action: str, operations: list[dict]) -> list[dict]:
+        if self.journal.pending():
+            raise models.ImgitError("An interrupted action is pending, run 'imgit resume' first")
+        return self.journal.plan(action, operations)
+
+    def run(self, operations: list[dict]) -> list[tuple[dict, Exception]]:
+        items = [operation for operation in operations if operation["op"] not in BATCHED_OPERATIONS]
+        for op, size in BATCHED_OPERATIONS.items():
+            batched = [operation for operation in operations if operation["op"] == op]
+            items += [batched[i:i + size] for i in range(0, len(batched), size)]
+        import tqdm
+        self._pbar = tqdm.tqdm(total=len(operations), unit="image")
+        upload_size = sum(
+            operation["image"]["local_size"] or 0
+            for operation in operations
+            if operation["op"] in UPLOAD_OPERATIONS
+        )
+        if upload_size:
+            self._bytes_pbar = tqdm.tqdm(total=upload_size, unit="B", unit_scale=True, unit_divisor=1024)
         try:
-            path.parent.mkdir(parents=True, exist_ok=True)
-            client.download(image.remote_link, path)
-        except models.ImgurError as err:
-            pbar.close()
-            write_index(root, index)
-            raise err
-        md5 = utils.hash_file(path)
-        stat = path.stat()
-        index[image.path].local_size = stat.st_size
-        index[image.path].local_ctime = stat.st_ctime
-        index[image.path].local_mtime = stat.st_mtime
-        index[image.path].local_md5 = md5
-        pbar.update(1)
-    pbar.close()
-    write_index(root, index)
-
-
-def push(client: Client, root: pathlib.Path = pathlib.Path(".")):
-    album = load_album(root)
-    index = load_index(root)
-    upload, change, delete = diff(root)[2:]
-    if not (upload or change or delete):
-        print("Push: already up to date.")
-        return
-    for image in delete:
-        del index[image.path]
-    pbar = tqdm.tqdm(total=len(upload) + len(change), unit="image")
-    for image in upload:
-        path = root / image.path
-        pbar.set_description("↑ " + path.name)
+            utils.run_concurrently(self._run_item, items, self.jobs)
+        finally:
+            self._pbar.close()
+            if self._bytes_pbar is not None:
+                self._bytes_pbar.close()
+            write_index(self.root, self.index)
+        if not self.failures:
+            self.journal.clear()
+            return []
+        for operation, err in self.failures:
+            utils.printc(f"! {operation['path']}: {err}", "red")
+        utils.printc(f"{len(self.failures)} operation(s) failed, run 'imgit resume' to retry them", "yellow")
+        return self.failures
+
+    def _run_item(self, item: dict | list[dict]):
+        operations = item if isinstance(item, list) else [item]
+        if isinstance(item, list):
+            self._pbar.set_description(f"{OPERATION_SYMBOLS[item[0]['op']]} {len(item)} image(s)")
+        else:
+            self._pbar.set_description(OPERATION_SYMBOLS[item["op"]] + " " + pathlib.Path(item["path"]).name)
+        self.journal.start(*operations)
         try:
-            online_image = client.upload_image(album.id, image, path)
+            getattr(self, "_" + operations[0]["op"])(item)
+        except (models.ImgurError, OSError) as err:
+            if not self.keep_going or isinstance(err, models.QuotaError):
+                raise
+            with self._lock:
+                self.failures += [(operation, err) for operation in operations]
+                self._pbar.update(len(operations))
+            return
+        with self._lock:
+            self.journal.done(*operations)
+            self.done[operations[0]["op"]] += len(operations)
+            self._pbar.update(len(operations))
+
+    def _listed(self, operation: dict) -> models.Image | None:
+        """When resuming an operation that was in flight, return what the album
+        listing holds at its target path.
+        """
+        if self.remote_index is None or not operation.get("started"):
+            return None
+        return self.remote_index.get(operation.get("dst", operation["path"]))
+
+    def _landed(self, operation: dict) -> models.Image | None:
+        """When resuming an upload that was in flight, return the image it put
+        online, if it did. The image at its path must have been uploaded after
+        the operation started and have the size of the file, otherwise it may
+        come from another clone.
+        """
+        listed = self._listed(operation)
+        if listed is None or listed.remote_id == operation.get("remote_id"):
+            return None
+        started_at = operation.get("started_at")
+        if started_at is None or listed.remote_datetime is None or listed.remote_datetime < int(started_at):
+            return None
+        if listed.remote_size != operation.get("started_size"):
+            return None
+        return listed
+
+    def _gone(self, operation: dict) -> bool:
+        """Tell whether a resumed operation already removed its remote image.
+        """
+        if self.remote_index is None or not operation.get("started"):
+            return False
+        listed = self._listed(operation)
+        return listed is None or listed.remote_id != operation["remote_id"]
+
+    def _download(self, operation: dict):
+        path = self.root / operation["path"]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        md5 = self.client.download(operation["remote_link"], path, self.algorithm)
+        stat = path.stat()
+        with self._lock:
+            image = self.index.get(operation["path"])
+            if image is None:
+                return
+            image.local_size = stat.st_size
+            image.local_ctime = stat.st_ctime
+            image.local_mtime = stat.st_mtime
+            image.local_md5 = md5
+            image.local_inode = stat.st_ino
+            image.local_hash_algorithm = self.algorithm
+            self.store.upsert([image])
+
+    def _sent(self, size: int):
+        if self._bytes_pbar is not None:
+            self._bytes_pbar.update(size)
+
+    def _upload(self, operation: dict):
+        image = models.Image(**operation["image"])
+        online_image = self._landed(operation)
+        if online_image is None:
+            online_image = self.client.upload_image(self.album.id, image, self.root / image.path, self._sent)
+        else:
+            self._sent(image.local_size or 0)
+        with self._lock:
             image.remote_id = online_image.remote_id
             image.remote_datetime = online_image.remote_datetime
             image.remote_link = online_image.remote_link
             image.remote_size = online_image.remote_size
             image.remote_delete_hash = online_image.remote_delete_hash
-            index.add(image)
-        except Exception as err:
-            pbar.close()
-            write_index(root, index)
-            raise err
-        pbar.update(1)
-    for image in change:
-        path = root / image.path
-        pbar.set_description(path.name)
+            self.index[image.path] = image
+            self.store.upsert([image])
+
+    def _replace(self, operation: dict):
+        if not self._gone(operation):
+            try:
+                self.client.delete_image(operation["remote_id"])
+            except models.NotFoundError:
+                # Already deleted, by an earlier attempt or by another clone
+                pass
+            with self._lock:
+                image = self.index[operation["path"]]
+                image.remote_id = None
+                image.remote_datetime = None
+                image.remote_link = None
+                image.remote_size = None
+                image.remote_delete_hash = None
+                self.store.upsert([image])
+        self._upload(operation)
+
+    def _delete(self, operation: dict):
+        if operation["remote_id"] is not None and not self._gone(operation):
+            self.client.delete_image(operation["remote_id"])
+        if operation["local"]:
+            (self.root / operation["path"]).unlink(missing_ok=True)
+        with self._lock:
+            self.index.pop(operation["path"], None)
+            self.store.delete([operation["path"]])
+
+    def _detach(self, operations: list[dict]):
+        self.client.remove_album_images(self.album.id, [operation["remote_id"] for operation in operations])
+        with self._lock:
+            for operation in operations:
+                self.index.pop(operation["path"], None)
+            self.store.delete([operation["path"] for operation in operations])
+
+    def _move(self, operation: dict):
+        listed = self._listed(operation)
+        if listed is None or listed.remote_id != operation["remote_id"]:
+            self.client.update_image_information(operation["remote_id"], operation["dst"])
+        src_path = self.root / operation["path"]
+        dst_path = self.root / operation["dst"]
+        if src_path.exists():
+            dst_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(src_path, dst_path)
+        with self._lock:
+            image = self.index.pop(operation["path"], None)
+            self.store.delete([operation["path"]])
+            if image is not None:
+                image.path = operation["dst"]
+                if "image" in operation:
+                    # The file was moved outside of imgit, its stat changed
+                    moved = models.Image(**operation["image"])
+                    image.local_size = moved.local_size
+                    image.local_ctime = moved.local_ctime
+                    image.local_mtime = moved.local_mtime
+                    image.local_md5 = moved.local_md5
+                    image.local_inode = moved.local_inode
+                    image.local_hash_algorithm = moved.local_hash_algorithm
+                self.index[image.path] = image
+                self.store.upsert([image])
+
+
+def pull(client: Client,
+         root: pathlib.Path = pathlib.Path("."),
+         rehash: bool = False,
+         algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+         jobs: int = 1,
+         plan: models.Plan | None = None) -> collections.Counter[str]:
+    """Download the images missing locally. Return the number of operations
+    that ran, by kind.
+    """
+    if plan is None:
+        plan = diff(root, rehash, algorithm)
+    index = plan.index
+    if not (plan.download or plan.link):
+        print("Pull: already up to date.")
+        return collections.Counter()
+    for image in plan.link:
+        index[image.path].local_size = image.local_size
+        index[image.path].local_ctime = image.local_ctime
+        index[image.path].local_mtime = image.local_mtime
+        index[image.path].local_md5 = image.local_md5
+        index[image.path].local_inode = image.local_inode
+        index[image.path].local_hash_algorithm = image.local_hash_algorithm
+    operations = Operations(client, root, index, algorithm, jobs)
+    operations.run(operations.plan("pull", [
+        {"op": "download", "path": image.path, "remote_link": image.remote_link}
+        for image in plan.download
+    ]))
+    return operations.done
+
+
+def build_content_index(plan: models.Plan, dedup_roots: list[pathlib.Path] | None = None) -> models.ContentIndex:
+    """Index the online images of the plan's album, and of the albums in
+    dedup_roots, by content hash.
+    """
+    content_index = models.ContentIndex()
+    for image in plan.index.values():
+        content_index.add(plan.album.id, image)
+    for other_root in dedup_roots or []:
+        other_album = load_album(other_root)
+        if other_album.id == plan.album.id:
+            continue
+        for image in load_index(other_root).values():
+            content_index.add(other_album.id, image)
+    return content_index
+
+
+def push(client: Client,
+         root: pathlib.Path = pathlib.Path("."),
+         rehash: bool = False,
+         algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+         jobs: int = 1,
+         plan: models.Plan | None = None,
+         skip_duplicates: bool = False,
+         dedup_roots: list[pathlib.Path] | None = None) -> collections.Counter[str]:
+    """Upload the local changes. Return the number of operations that ran, by
+    kind, counting the images gone from both sides as deletions.
+    """
+    if plan is None:
+        plan = diff(root, rehash, algorithm)
+    content_index = build_content_index(plan, dedup_roots)
+    index = plan.index
+    if not (plan.upload or plan.change or plan.delete or plan.rename):
+        print("Push: already up to date.")
+        return collections.Counter()
+    for image in plan.delete:
+        del index[image.path]
+    upload = []
+    batch: dict[tuple[str | None, str], models.Image] = {}
+    for image in plan.upload:
+        key = (image.local_hash_algorithm, image.local_md5)
+        if content_index.find(image):
+            album_id, match = content_index.find(image)[0]
+            utils.printc(f"= {image.path} is already online as {match.path} in album {album_id}", "yellow")
+        elif key in batch:
+            utils.printc(f"= {image.path} has the same content as {batch[key].path}", "yellow")
+        else:
+            batch[key] = image
+            upload.append(image)
+            continue
+        if not skip_duplicates:
+            upload.append(image)
+    operations = Operations(client, root, index, algorithm, jobs)
+    operations.run(operations.plan("push", [
+        {"op": "move", "path": old.path, "dst": new.path, "remote_id": old.remote_id, "image": dataclasses.asdict(new)}
+        for old, new in plan.rename
+    ] + [
+        {"op": "upload", "path": image.path, "image": dataclasses.asdict(image)}
+        for image in upload
+    ] + [
+        {"op": "replace", "path": image.path, "image": dataclasses.asdict(image), "remote_id": index[image.path].remote_id}
+        for image in plan.change
+    ]))
+    operations.done["delete"] += len(plan.delete)
+    return operations.done
+
+
+def sync(client: Client,
+         root: pathlib.Path = pathlib.Path("."),
+         rehash: bool = False,
+         algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+         jobs: int = 1,
+         skip_duplicates: bool = False,
+         dedup_roots: list[pathlib.Path] | None = None) -> collections.Counter[str]:
+    plan = diff(root, rehash, algorithm)
+    done = pull(client, root, algorithm=algorithm, jobs=jobs, plan=plan)
+    done += push(client, root, algorithm=algorithm, jobs=jobs, plan=plan, skip_duplicates=skip_duplicates, dedup_roots=dedup_roots)
+    return done
+
+
+def format_operation_counts(counts: collections.Counter[str]) -> str:
+    by_symbol = collections.Counter()
+    for op, symbol in OPERATION_SYMBOLS.items():
+        by_symbol[symbol] += counts[op]
+    return " ".join(f"{symbol} {count}" for symbol, count in by_symbol.items() if count) or "up to date"
+
+
+def find_roots(folder: pathlib.Path) -> list[pathlib.Path]:
+    """Return the imgit folders below a folder, without looking inside them.
+    """
+    roots = []
+    for top, dirnames, _ in os.walk(folder):
+        if (pathlib.Path(top) / models.IMGIT_FOLDER / "meta.json").exists():
+            roots.append(pathlib.Path(top))
+            dirnames.clear()
+    return sorted(roots)
+
+
+def sync_recursive(client: Client,
+         folder: pathlib.Path,
+         rehash: bool = False,
+         algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+         jobs: int = 1,
+         albums: int = 1,
+         skip_duplicates: bool = False,
+         dedup_roots: list[pathlib.Path] | None = None):
+    """Sync every album below a folder, several at a time. All albums share the
+    client, hence its connections and its rate limiter.
+    """
+    roots = find_roots(folder)
+    if not roots:
+        raise models.ImgitError(f"No imgit folder in '{folder}'")
+    print(f"Syncing {len(roots)} album(s)...")
+    summary: dict[pathlib.Path, str] = {}
+    failed: set[pathlib.Path] = set()
+
+    def sync_one(root: pathlib.Path):
+        start = time.time()
         try:
-            client.delete_image(index[image.path].remote_id)
-            index[image.path].remote_id = None
-            index[image.path].remote_datetime = None
-            index[image.path].remote_link = None
-            index[image.path].remote_size = None
-            index[image.path].remote_delete_hash = None
-            online_image = client.upload_image(album.id, image, path)
-            image.remote_id = online_image.remote_id
-            image.remote_datetime = online_image.remote_datetime
-            image.remote_link = online_image.remote_link
-            image.remote_size = online_image.remote_size
-            image.remote_delete_hash = online_image.remote_delete_hash
-            index[image.path] = image
+            done = sync(client, root, rehash, algorithm, jobs, skip_duplicates, dedup_roots)
+            summary[root] = f"{format_operation_counts(done)} in {utils.format_duration(time.time() - start)}"
         except Exception as err:
-            pbar.close()
-            write_index(root, index)
-            raise err
-        pbar.update(1)
-    pbar.close()
-    write_index(root, index)
-
+            # Whatever goes wrong with an album, the others carry on
+            summary[root] = f"{err.__class__.__name__}: {err}"
+            failed.add(root)
 
-def sync(client: Client, root: pathlib.Path = pathlib.Path(".")):
-    pull(client, root)
-    push(client, root)
+    utils.run_concurrently(sync_one, roots, albums)
+    for root in roots:
+        utils.printc(("x " if root in failed else "✓ ") + f"{root.as_posix()}: {summary[root]}", "red" if root in failed else "green")
 
 
-def rm(client: Client, pattern: str, force: bool = False, root: pathlib.Path = pathlib.Path(".")):
-    album = load_album(root)
+def rm(client: Client, pattern: str, force: bool = False, root: pathlib.Path = pathlib.Path("."), jobs: int = 1):
     index = load_index(root)
     delete = set()
     for path in glob.glob(os.path.join(root, pattern)):
@@ -299,26 +775,15 @@ def rm(client: Client, pattern: str, force: bool = False, root: pathlib.Path = p
                 utils.printc("x " +  path, "red")
             if not utils.confirm("Proceed?"):
                 return
-        pbar = tqdm.tqdm(total=len(delete), unit="image")
-        for image_path in delete:
-            path = root / image_path
-            pbar.set_description(path.name)
-            try:
-                client.delete_image(index[image_path].remote_id)
-                os.remove(path)
-                del index[image_path]
-            except Exception as err:
-                pbar.close()
-                write_index(root, index)
-                raise err
-            pbar.update(1)
-        pbar.close()
-        write_index(root, index)
+        operations = Operations(client, root, index, jobs=jobs, keep_going=True)
+        operations.run(operations.plan("rm", [
+            {"op": "delete", "path": image_path, "remote_id": index[image_path].remote_id, "local": True}
+            for image_path in sorted(delete)
+        ]))
     utils.remove_empty_directories(root)
 
 
-def mv(client: Client, src: pathlib.Path, dst: pathlib.Path, root: pathlib.Path = pathlib.Path(".")):
-    album = load_album(root)
+def mv(client: Client, src: pathlib.Path, dst: pathlib.Path, root: pathlib.Path = pathlib.Path("."), jobs: int = 1):
     index = load_index(root)
     src = root / src
     dst = root / dst
@@ -337,29 +802,33 @@ def mv(client: Client, src: pathlib.Path, dst: pathlib.Path, root: pathlib.Path
     for image_path, _ in move:
         if image_path not in index or not index[image_path].online or not index[image_path].offline:
             raise models.ImgitError(f"Trying to move image before it is synced: '{image_path}'")
-    pbar = tqdm.tqdm(total=len(move), unit="image")
-    for image_path, dst_path in move:
-        src_path = root / image_path
-        pbar.set_description(src_path.name)
-        try:
-            new_path = dst_path.relative_to(root).as_posix()
-            client.update_image_information(index[image_path].remote_id, new_path)
-            dst_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(src_path, dst_path)
-            image = index[image_path]
-            image.path = new_path
-            index[new_path] = image
-            del index[image_path]
-        except Exception as err:
-            pbar.close()
-            write_index(root, index)
-            raise err
-        pbar.update(1)
-    pbar.close()
-    write_index(root, index)
+    operations = Operations(client, root, index, jobs=jobs, keep_going=True)
+    operations.run(operations.plan("mv", [
+        {"op": "move", "path": image_path, "dst": dst_path.relative_to(root).as_posix(), "remote_id": index[image_path].remote_id}
+        for image_path, dst_path in move
+    ]))
     utils.remove_empty_directories(root)
 
 
+def resume(client: Client,
+           root: pathlib.Path = pathlib.Path("."),
+           algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+           jobs: int = 1):
+    pending = journal.Journal(root).pending()
+    operations = Operations(client, root, load_index(root), algorithm, jobs)
+    if not pending:
+        print("Nothing to resume.")
+        operations.journal.clear()
+        return
+    if any(operation["started"] for operation in pending):
+        # In-flight operations may or may not have reached Imgur
+        operations.remote_index = client.get_album_images(operations.album.id)
+    print(f"Resuming {len(pending)} operation(s) of {', '.join(sorted({o['action'] for o in pending}))}")
+    operations.run(pending)
+    if any(operation["op"] in ["delete", "move"] for operation in pending):
+        utils.remove_empty_directories(root)
+
+
 def init(client: Client, url: str | None = None, root: pathlib.Path = pathlib.Path(".")):
     if (root / models.IMGIT_FOLDER).exists():
         raise models.ImgitError("imgit already initialized")
@@ -376,41 +845,135 @@ def init(client: Client, url: str | None = None, root: pathlib.Path = pathlib.Pa
     fetch(client, root)
 
 
-def remove(client: Client, root: pathlib.Path = pathlib.Path(".")):
-    album = load_album(root)
-    index = load_index(root)
-    local_index = build_local_index(root)
-    delete = []
-    for image in index.values():
-        if image.online and not (image.path in local_index):
-            delete.append(image)
+def remove(client: Client,
+           root: pathlib.Path = pathlib.Path("."),
+           rehash: bool = False,
+           algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+           jobs: int = 1,
+           detach: bool = False):
+    """Remove online images that do not exist locally. With detach, they are
+    only taken out of the album, in batches, instead of being deleted.
+    """
+    plan = diff(root, rehash, algorithm)
+    index = plan.index
+    delete = plan.download
     for image in delete:
         utils.printc("x " +  image.path, "red")
     if not utils.confirm("Proceed?"):
         return
-    pbar = tqdm.tqdm(total=len(delete), unit="image")
-    for image in delete:
-        path = root / image.path
-        pbar.set_description(path.name)
-        try:
-            client.delete_image(image.remote_id)
-            del index[image.path]
-        except Exception as err:
-            pbar.close()
-            write_index(root, index)
-            raise err
-        pbar.update(1)
-    pbar.close()
-    write_index(root, index)
+    operations = Operations(client, root, index, jobs=jobs, keep_going=True)
+    operations.run(operations.plan("remove", [
+        {"op": "detach", "path": image.path, "remote_id": image.remote_id}
+        if detach else
+        {"op": "delete", "path": image.path, "remote_id": image.remote_id, "local": False}
+        for image in delete
+    ]))
+
+
+def sync_changes(client: Client,
+        changes: watching.Changes,
+        root: pathlib.Path = pathlib.Path("."),
+        algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+        jobs: int = 1,
+        delete: bool = False):
+    """Push the changes reported by a watcher: moves of synced files become
+    metadata updates and new and modified files are uploaded. Deleted files are
+    removed online only with delete, otherwise the next pull restores them,
+    as sync does.
+    """
+    paths = set(changes.paths)
+    index = load_index(root)
+    move = []
+    for src, dst in changes.moves:
+        image = index.get(src)
+        if image is not None and image.online and image.offline and (root / dst).is_file():
+            move.append({"op": "move", "path": src, "dst": dst, "remote_id": image.remote_id})
+        else:
+            paths.update([src, dst])
+    if move:
+        operations = Operations(client, root, index)
+        operations.run(operations.plan("mv", move))
+    if not paths:
+        return
+    plan = diff(root, algorithm=algorithm, paths=paths)
+    if plan.upload or plan.change or plan.delete or plan.rename:
+        push(client, root, algorithm=algorithm, jobs=jobs, plan=plan)
+    # Only images that were local and got removed are deleted online, the
+    # ones not downloaded yet, under a changed folder, wait for the next pull
+    removed = [image for image in plan.download if image.offline]
+    if removed and not delete:
+        for image in removed:
+            utils.printc(f"x {image.path} was removed locally, kept online, watch with --delete to remove it", "yellow")
+    elif removed:
+        operations = Operations(client, root, plan.index, jobs=jobs)
+        operations.run(operations.plan("remove", [
+            {"op": "delete", "path": image.path, "remote_id": image.remote_id, "local": False}
+            for image in removed
+        ]))
+
+
+def watch(client: Client,
+          root: pathlib.Path = pathlib.Path("."),
+          algorithm: str = utils.DEFAULT_HASH_ALGORITHM,
+          jobs: int = 1,
+          debounce: float = 2,
+          fetch_interval: float = 300,
+          poll: bool = False,
+          poll_interval: float = 5,
+          delete: bool = False):
+    """Keep the album in sync with the folder until interrupted. Local changes
+    are pushed as soon as they settle, and remote changes are pulled every
+    fetch_interval seconds. Files deleted locally are only deleted online with
+    delete.
+    """
+    from . import watching
+    load_album(root)
+    watcher = watching.create_watcher(root, poll, poll_interval)
+    watcher.start()
+    print(f"Watching '{root.absolute()}' with {watcher.__class__.__name__}, press ^C to stop")
+    try:
+        if journal.Journal(root).pending():
+            resume(client, root, algorithm, jobs)
+        sync(client, root, algorithm=algorithm, jobs=jobs)
+        last_fetch = time.time()
+        pending = watching.Changes()
+        while True:
+            timeout = max(0, last_fetch + fetch_interval - time.time())
+            changes = watcher.wait(timeout, debounce)
+            pending.paths.update(changes.paths)
+            pending.moves.extend(changes.moves)
+            try:
+                if journal.Journal(root).pending():
+                    resume(client, root, algorithm, jobs)
+                if pending:
+                    sync_changes(client, pending, root, algorithm, jobs, delete)
+                    pending = watching.Changes()
+                if time.time() >= last_fetch + fetch_interval:
+                    fetch(client, root)
+                    pull(client, root, algorithm=algorithm, jobs=jobs)
+                    last_fetch = time.time()
+            except (models.ImgurError, models.ImgitError, OSError) as err:
+                # Keep the changes for the next round, network may come back
+                # and files being written may settle
+                utils.printc("Error: " + str(err), "red")
+                last_fetch = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
 
 
-def gui(host: str = "127.0.0.1:8000", root: pathlib.Path = pathlib.Path(".")):
+def gui(host: str = "127.0.0.1:8000", root: pathlib.Path = pathlib.Path("."), live: bool = False):
     album = load_album(root)
     index = load_index(root)
-    server = GuiServer(host, root.absolute(), album, index)
+    import webbrowser
+    from .gui import GuiServer
+    server = GuiServer(host, root.absolute(), album, index, live)
     print(f"Listening to http://{host}, press ^C to stop")
     webbrowser.open(f"http://{host}")
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        server.server_close()
@@ -1,14 +1,23 @@
+import bisect
 import dataclasses
 import html
 import http.server
+import os
 import pathlib
 import random
+import threading
 import time
+import typing
+import urllib.parse
+import uuid
 import webbrowser
 
 import requests
+import requests.adapters
+import urllib3.util
 
 from . import models
+from . import profiling
 from . import utils
 
 
@@ -80,12 +89,252 @@ class AuthServer(http.server.HTTPServer):
         self.token: Token | None = None
 
 
+API_URL = models.API_URL
+API_PATH_SEGMENTS = {"3", "album", "image", "images", "upload", "remove_images", "oauth2", "token"}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # bytes
+RETRY_STATUSES = [500, 502, 503, 504]
+# Only these are retried after the request was sent. Connection errors are
+# retried for any method, since nothing reached the server: uploads are never
+# posted twice.
+RETRY_METHODS = ["GET", "HEAD", "DELETE"]
+UPLOAD_CHUNK_SIZE = 64 * 1024 # bytes
+
+
+def quote_header_value(value: str) -> str:
+    """Escape a Content-Disposition parameter the way browsers do."""
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class MultipartEncoder:
+    """Body of a multipart/form-data request, read from the files while it is
+    sent, so that memory use does not depend on their size.
+
+    It is seekable, so that the request can be sent again after a quota wait
+    or a connection error, and calls progress with the number of file bytes
+    read, negative when rewound.
+    """
+
+    def __init__(self,
+            fields: dict[str, str],
+            files: dict[str, tuple[str, typing.BinaryIO]],
+            progress: typing.Callable[[int], None] | None = None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.progress = progress
+        # Segments of the body: bytes, or (file, start, size) read on demand
+        self._segments: list[bytes | tuple[typing.BinaryIO, int, int]] = []
+        for name, value in fields.items():
+            self._segments.append(self._part_header(name) + value.encode("utf8") + b"\r\n")
+        for name, (filename, file) in files.items():
+            start = file.tell()
+            self._segments.append(self._part_header(name, filename))
+            self._segments.append((file, start, os.fstat(file.fileno()).st_size - start))
+            self._segments.append(b"\r\n")
+        self._segments.append(f"--{self.boundary}--\r\n".encode())
+        self._offsets = []
+        self._length = 0
+        for segment in self._segments:
+            self._offsets.append(self._length)
+            self._length += len(segment) if isinstance(segment, bytes) else segment[2]
+        self._position = 0
+
+    def _part_header(self, name: str, filename: str | None = None) -> bytes:
+        disposition = f'form-data; name="{quote_header_value(name)}"'
+        if filename is None:
+            return f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n\r\n".encode("utf8")
+        disposition += f'; filename="{quote_header_value(filename)}"'
+        return f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\nContent-Type: application/octet-stream\r\n\r\n".encode("utf8")
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        while chunk := self.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._length
+        offset = max(0, min(offset, self._length))
+        if self.progress is not None:
+            self.progress(self._file_bytes(offset) - self._file_bytes(self._position))
+        self._position = offset
+        return offset
+
+    def _file_bytes(self, position: int) -> int:
+        """Number of file bytes before position in the body."""
+        total = 0
+        for offset, segment in zip(self._offsets, self._segments):
+            if offset >= position:
+                break
+            if not isinstance(segment, bytes):
+                total += min(segment[2], position - offset)
+        return total
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length - self._position
+        chunks = []
+        file_bytes = 0
+        while size > 0 and self._position < self._length:
+            i = bisect.bisect_right(self._offsets, self._position) - 1
+            segment = self._segments[i]
+            skip = self._position - self._offsets[i]
+            if isinstance(segment, bytes):
+                chunk = segment[skip:skip + size]
+            else:
+                file, start, length = segment
+                file.seek(start + skip)
+                chunk = file.read(min(size, length - skip))
+                if not chunk:
+                    raise models.ImgitError(f"{getattr(file, 'name', 'File')} was truncated while uploading it")
+                file_bytes += len(chunk)
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        if file_bytes and self.progress is not None:
+            self.progress(file_bytes)
+        return b"".join(chunks)
+
+
+def create_session(pool_size: int = 10, retries: int = 3) -> requests.Session:
+    retry = urllib3.util.Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        other=0,
+        allowed_methods=RETRY_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@dataclasses.dataclass
+class Budget:
+    limit: int
+    remaining: int
+    reset: float # timestamp
+
+
+class RateLimiter:
+    """Token bucket fed by the rate limit headers of Imgur responses.
+
+    While a budget is mostly unspent, requests only are delay seconds apart.
+    As it runs out, the remaining requests are spread evenly over the time left
+    before it resets. Parking the limiter holds every request until a given
+    time, which is how a reached quota is waited out.
+    """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.budgets: dict[str, Budget] = {}
+        self.slept: float = 0
+        self._lock = threading.Lock()
+        self._next_slot: float = 0
+
+    def interval(self, post: bool = False, at: float | None = None) -> float:
+        at = time.time() if at is None else at
+        interval = self.delay
+        for name, budget in self.budgets.items():
+            if (name == "post" and not post) or budget.reset <= at:
+                continue
+            window = budget.reset - at
+            if budget.remaining <= 0:
+                interval = max(interval, window)
+            elif budget.limit > 0:
+                pressure = 1 - min(budget.remaining, budget.limit) / budget.limit
+                interval = max(interval, pressure * window / budget.remaining)
+        return interval
+
+    def wait(self, post: bool = False):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval(post, slot)
+        if slot > now:
+            start = time.perf_counter()
+            time.sleep(slot - now)
+            profiling.record("rate limit sleep", start, time.perf_counter() - start)
+            with self._lock:
+                self.slept += slot - now
+
+    def park(self, until: float):
+        with self._lock:
+            self._next_slot = max(self._next_slot, until)
+
+    def update(self, headers: dict[str, str]):
+        now = time.time()
+        budgets = {}
+        if "X-RateLimit-UserRemaining" in headers:
+            budgets["user"] = Budget(
+                limit=int(headers.get("X-RateLimit-UserLimit", 0)),
+                remaining=int(headers["X-RateLimit-UserRemaining"]),
+                reset=float(headers.get("X-RateLimit-UserReset", now + 3600)))
+        if "X-RateLimit-ClientRemaining" in headers:
+            # Imgur does not send the client reset time, it resets daily
+            budgets["client"] = Budget(
+                limit=int(headers.get("X-RateLimit-ClientLimit", 0)),
+                remaining=int(headers["X-RateLimit-ClientRemaining"]),
+                reset=now + 86400 - now % 86400)
+        if "X-Post-Rate-Limit-Remaining" in headers:
+            budgets["post"] = Budget(
+                limit=int(headers.get("X-Post-Rate-Limit-Limit", 0)),
+                remaining=int(headers["X-Post-Rate-Limit-Remaining"]),
+                reset=now + float(headers.get("X-Post-Rate-Limit-Reset", 3600)))
+        with self._lock:
+            self.budgets.update(budgets)
+
+    def reset_time(self, post: bool = False) -> float:
+        now = time.time()
+        resets = [
+            budget.reset
+            for name, budget in self.budgets.items()
+            if budget.remaining <= 0 and (post or name != "post")
+        ]
+        return max(resets, default=now + 60)
+
+
+def endpoint_name(method: str, url: str) -> str:
+    """Name of the endpoint of a request, for profiling, with the ids
+    replaced by placeholders.
+    """
+    path = urllib.parse.urlparse(url).path
+    segments = [segment if segment in API_PATH_SEGMENTS else "{id}" for segment in path.strip("/").split("/")]
+    return f"http {method.upper()} /{'/'.join(segments)}"
+
+
+def is_quota_error(response: requests.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    try:
+        return response.json()["errors"][0]["code"] == 429
+    except Exception:
+        return False
+
+
 class Client:
 
     def __init__(self,
             credentials_path: str,
             token_path: str | None = None,
-            delay: float = 1):
+            delay: float = 0,
+            wait_on_quota: bool = False,
+            pool_size: int = 10,
+            retries: int = 3,
+            timeout: float = 60,
+            api_url: str = API_URL):
         if not pathlib.Path(credentials_path).exists():
             raise models.ImgitError("No credentials")
         self.credentials = utils.read_dataclass(Credentials, credentials_path)
@@ -93,13 +342,17 @@ class Client:
             self.token_path = pathlib.Path.home() / ".config" / "imgit" / "token.json"
         else:
             self.token_path = pathlib.Path(token_path)
-        self.delay = delay
-        self._last_request: int = 0
+        self.limiter = RateLimiter(delay)
+        self.wait_on_quota = wait_on_quota
+        self.session = create_session(pool_size, retries)
+        self.timeout = timeout
+        self.api_url = api_url.rstrip("/")
         self._token: Token | None = None
+        self._token_lock = threading.Lock()
 
     def retrieve_token(self):
         state = hash(random.random())
-        auth_url = f"https://api.imgur.com/oauth2/authorize?client_id={self.credentials.client_id}&response_type=token&state={state}"
+        auth_url = f"{self.api_url}/oauth2/authorize?client_id={self.credentials.client_id}&response_type=token&state={state}"
         print("Opening browser for authentication...")
         print("If the browser does not open, please open the following URL manually:")
         print(auth_url)
@@ -119,71 +372,106 @@ class Client:
 
     @property
     def token(self) -> Token:
-        if self._token is None:
-            if self.token_path.exists():
-                self._token = utils.read_dataclass(Token, self.token_path)
-            else:
-                self.retrieve_token()
+        with self._token_lock:
+            if self._token is None:
+                if self.token_path.exists():
+                    self._token = utils.read_dataclass(Token, self.token_path)
+                else:
+                    self.retrieve_token()
         return self._token
 
     def request(self,
             method: str,
             url: str,
-            data: dict | None = None,
-            files: dict | None = None,
+            data: dict | MultipartEncoder | None = None,
             json_data: dict | None = None) -> dict:
         headers = {"Authorization": f"Bearer {self.token.access_token}"}
-        now = time.time()
-        if now - self._last_request < self.delay:
-            time.sleep(self.delay - (now - self._last_request))
-        self._last_request = now
-        if method.lower() == "get":
-            response = requests.get(url, headers=headers)
-        elif method.lower() == "post":
-            response = requests.post(url, headers=headers, data=data, files=files, json=json_data)
-        elif method.lower() == "delete":
-            response = requests.delete(url, headers=headers)
-        else:
+        if isinstance(data, MultipartEncoder):
+            headers["Content-Type"] = data.content_type
+        if method.lower() not in ["get", "post", "delete"]:
             raise ValueError(f"Unknown method {method}")
+        post = method.lower() == "post"
+        while True:
+            self.limiter.wait(post)
+            try:
+                with profiling.phase(endpoint_name(method, url)):
+                    response = self.session.request(
+                        method.upper(),
+                        url,
+                        headers=headers,
+                        data=data,
+                        json=json_data,
+                        timeout=self.timeout)
+            except requests.RequestException as err:
+                raise models.ImgurError(f"Request failed for {method} {url}: {err}") from err
+            body = response.request.body
+            profiling.count("bytes sent", len(body) if isinstance(body, (bytes, str, MultipartEncoder)) else 0)
+            profiling.count("bytes received", len(response.content))
+            self.limiter.update(response.headers)
+            if not is_quota_error(response):
+                break
+            reset = self.limiter.reset_time(post)
+            if not self.wait_on_quota:
+                raise models.QuotaError(f"Reached API quota, try again in {utils.format_duration(reset - time.time())}")
+            utils.printc(f"Reached API quota, resuming in {utils.format_duration(reset - time.time())}", "yellow")
+            self.limiter.park(reset)
+            if isinstance(data, MultipartEncoder):
+                data.seek(0)
         try:
-            data = response.json()
+            body = response.json()
         except Exception as err:
             raise models.ImgurError(f"Wrong response (status code {response.status_code}) for {method} {url}") from err
-        if "errors" in data:
-            error = data["errors"][0]
-            if error["code"] == 429:
-                user_reset = float(response.headers.get("X-RateLimit-UserReset", 0))
-                raise models.QuotaError(f"Reached API quota, try again in {utils.format_duration(user_reset)}")
-            raise models.ImgurError(f"{error['code']} {error['status']}: {error['detail']}")
-        if not "success" in data or not data["success"] or "data" not in data:
-            raise models.ImgurError(f"Illegal response '{data}'")
-        return data["data"]
-
-    def download(self, url: str, path: str | pathlib.Path):
-        now = time.time()
-        if now - self._last_request < self.delay:
-            time.sleep(self.delay - (now - self._last_request))
-        self._last_request = now
+        if "errors" in body:
+            error = body["errors"][0]
+            error_class = models.NotFoundError if error["code"] == 404 else models.ImgurError
+            raise error_class(f"{error['code']} {error['status']}: {error['detail']}")
+        if response.status_code == 404:
+            raise models.NotFoundError(f"404 Not Found: {method} {url}")
+        if not "success" in body or not body["success"] or "data" not in body:
+            raise models.ImgurError(f"Illegal response '{body}'")
+        return body["data"]
+
+    def download(self, url: str, path: str | pathlib.Path, algorithm: str = utils.DEFAULT_HASH_ALGORITHM) -> str:
+        """Stream the file at url to path, through a temporary file that is
+        renamed once complete, and return its hash.
+        """
+        self.limiter.wait()
         headers = {"User-Agent": "Mozilla/5.0 (Linux; Android 6.0; MYA-L22 Build/HUAWEIMYA-L22) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.84 Mobile Safari/537.36"}
-        response = requests.get(url, headers=headers)
-        if not response.status_code == 200:
-            raise models.ImgurError(f"Got status {response.status_code} when downloading file")
-        with open(path, "wb") as file:
-            file.write(response.content)
+        path = pathlib.Path(path)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.part")
+        hasher = utils.new_hasher(algorithm)
+        try:
+            with profiling.phase("http GET download"), self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if not response.status_code == 200:
+                    raise models.ImgurError(f"Got status {response.status_code} when downloading file")
+                try:
+                    with open(tmp_path, "wb") as file:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            file.write(chunk)
+                            hasher.update(chunk)
+                            profiling.count("bytes received", len(chunk))
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+        except requests.RequestException as err:
+            raise models.ImgurError(f"Download failed for {url}: {err}") from err
+        os.replace(tmp_path, path)
+        return hasher.hexdigest()
 
     def get_album(self, album_id: str) -> models.Album:
-        data = self.request("get", f"https://api.imgur.com/3/album/{album_id}")
+        data = self.request("get", f"{self.api_url}/3/album/{album_id}")
         return models.Album(
             id=data["id"],
             delete_hash=data["deletehash"],
             title=html.unescape(data["title"]),
             description=html.unescape(data["description"]),
             datetime=data["datetime"],
-            link=data["link"]
+            link=data["link"],
+            images_count=data.get("images_count")
         )
 
     def create_album(self, album_title: str) -> models.Album:
-        data = self.request("post", "https://api.imgur.com/3/album", json_data={
+        data = self.request("post", f"{self.api_url}/3/album", json_data={
             "title": album_title,
             "description": ""
         })
@@ -191,7 +479,7 @@ class Client:
         return self.get_album(album_id)
 
     def get_album_images(self, album_id: str) -> models.Index:
-        data = self.request("get", f"https://api.imgur.com/3/album/{album_id}/images")
+        data = self.request("get", f"{self.api_url}/3/album/{album_id}/images")
         index = models.Index()
         if data is None:
             return index
@@ -214,21 +502,27 @@ class Client:
             ))
         return index
 
-    def upload_image(self, album_id: str, image: models.Image, path: pathlib.Path) -> models.Image:
+    def upload_image(self,
+            album_id: str,
+            image: models.Image,
+            path: pathlib.Path,
+            progress: typing.Callable[[int], None] | None = None) -> models.Image:
+            """Upload a file, streamed from the disk. progress is called with the
+            number of bytes sent as the upload goes.
+            """
             with open(path, "rb") as file:
                 d = self.request(
                     "post",
-                    "https://api.imgur.com/3/upload",
-                    data={
+                    f"{self.api_url}/3/upload",
+                    data=MultipartEncoder({
                         "type": "file",
                         "name": path.name,
                         "title": image.path,
                         "description": image.path,
                         "album": album_id
-                    },
-                    files={
-                        "image": file
-                    })
+                    }, {
+                        "image": (path.name, file)
+                    }, progress))
             return models.Image(
                 path=image.path,
                 remote_id=d["id"],
@@ -243,10 +537,18 @@ class Client:
             )
 
     def delete_image(self, image_id: str):
-        self.request("delete", f"https://api.imgur.com/3/image/{image_id}")
+        self.request("delete", f"{self.api_url}/3/image/{image_id}")
+
+    def remove_album_images(self, album_id: str, image_ids: list[str]):
+        """Take images out of an album, in a single request, without deleting
+        them.
+        """
+        self.request("post", f"{self.api_url}/3/album/{album_id}/remove_images", data={
+            "ids[]": image_ids
+        })
 
     def update_image_information(self, image_id: str, title_and_description: str):
-        self.request("post", f"https://api.imgur.com/3/image/{image_id}", json_data={
+        self.request("post", f"{self.api_url}/3/image/{image_id}", json_data={
             "title": title_and_description,
             "description": title_and_description
         })
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""Long running process serving the actions of an album over a Unix socket,
+so that repeated commands reuse its warm index, imported modules and pooled
+HTTP connections instead of starting from scratch.
+
+The protocol is one JSON object per line. The CLI sends a request, such as
+{"action": "status", "arguments": {...}}, and the daemon answers with the
+output of the action, as {"stream": "stdout", "text": ...} messages, then a
+final {"done": true} or {"error": ..., "color": ...} message.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+import typing
+
+from . import actions
+from . import models
+from . import storage
+from . import utils
+
+if typing.TYPE_CHECKING:
+    from .client import Client
+
+
+SOCKET_NAME = "daemon.sock"
+# Actions the CLI forwards to a running daemon
+DAEMON_ACTIONS = ["status", "fetch", "pull", "push"]
+# Unix socket paths are limited to about a hundred bytes
+MAX_SOCKET_PATH = 100
+
+
+def socket_path(root: pathlib.Path) -> pathlib.Path:
+    path = root.resolve() / models.IMGIT_FOLDER / SOCKET_NAME
+    if len(os.fsencode(path)) > MAX_SOCKET_PATH:
+        digest = hashlib.md5(os.fsencode(path)).hexdigest()[:16]
+        path = pathlib.Path(tempfile.gettempdir()) / f"imgit-{digest}.sock"
+    return path
+
+
+def send_message(connection: socket.socket, **message):
+    connection.sendall(json.dumps(message).encode("utf8") + b"\n")
+
+
+class SocketWriter(io.TextIOBase):
+    """Text stream forwarding what is written to the CLI connected to the
+    daemon. If the CLI goes away, the action keeps running, so that it does
+    not stop halfway, and its output is dropped.
+    """
+
+    encoding = "utf8"
+
+    def __init__(self, connection: socket.socket, stream: str):
+        self.connection = connection
+        self.stream = stream
+        self.disconnected = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if text and not self.disconnected:
+            try:
+                send_message(self.connection, stream=self.stream, text=text)
+            except OSError:
+                self.disconnected = True
+        return len(text)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+
+    server: Daemon
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        if request["action"] == "stop":
+            send_message(self.connection, done=True)
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        stdout = SocketWriter(self.connection, "stdout")
+        stderr = SocketWriter(self.connection, "stderr")
+        # Standard streams are global to the process: actions run one at a
+        # time, which they would have to anyway as they share the index
+        with self.server.lock, contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                self.server.run(request["action"], request.get("arguments", {}))
+            except models.QuotaError as err:
+                self.send_error(str(err), "yellow")
+            except (models.ImgurError, models.ImgitError) as err:
+                self.send_error(str(err), "red")
+            except Exception as err:
+                traceback.print_exc()
+                self.send_error(repr(err), "red")
+            else:
+                self.send_message(done=True)
+
+    def send_error(self, message: str, color: str):
+        self.send_message(error=message, color=color)
+
+    def send_message(self, **message):
+        try:
+            send_message(self.connection, **message)
+        except OSError:
+            pass
+
+
+class Daemon(socketserver.ThreadingUnixStreamServer):
+    """Serve the actions of the album in root, with a client created once, and
+    the index kept in memory between requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: pathlib.Path, client: Client):
+        self.root = root.resolve()
+        self.client = client
+        self.lock = threading.Lock()
+        actions.load_album(self.root)
+        storage.open_store(self.root).keep_in_memory()
+        path = socket_path(self.root)
+        if is_running(self.root):
+            raise models.ImgitError(f"A daemon is already running on {path}")
+        path.unlink(missing_ok=True)
+        socketserver.ThreadingUnixStreamServer.__init__(self, str(path), DaemonHandler)
+        os.chmod(path, 0o600)
+
+    def run(self, action: str, arguments: dict):
+        if action == "status":
+            actions.status(self.root, **arguments)
+        elif action == "fetch":
+            actions.fetch(self.client, self.root, **arguments)
+        elif action == "pull":
+            actions.pull(self.client, self.root, **arguments)
+        elif action == "push":
+            dedup_with = arguments.pop("dedup_with", None)
+            dedup_roots = None if dedup_with is None else actions.find_roots(pathlib.Path(dedup_with))
+            actions.push(self.client, self.root, dedup_roots=dedup_roots, **arguments)
+        else:
+            raise models.ImgitError(f"The daemon does not serve {action}")
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        pathlib.Path(self.server_address).unlink(missing_ok=True)
+
+
+def serve(client: Client, root: pathlib.Path = pathlib.Path(".")):
+    daemon = Daemon(root, client)
+    print(f"Serving {daemon.root.as_posix()} on {daemon.server_address}, press Ctrl+C to stop")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+def connect(root: pathlib.Path) -> socket.socket | None:
+    path = socket_path(root)
+    if not path.exists():
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(path))
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def is_running(root: pathlib.Path) -> bool:
+    connection = connect(root)
+    if connection is None:
+        return False
+    connection.close()
+    return True
+
+
+def request(root: pathlib.Path, action: str, arguments: dict | None = None) -> bool:
+    """Run an action in the daemon of the album in root, printing its output.
+    Return False if no daemon is running, for the caller to run the action
+    itself.
+    """
+    connection = connect(root)
+    if connection is None:
+        return False
+    with connection, connection.makefile("rb") as reader:
+        send_message(connection, action=action, arguments=arguments or {})
+        for line in reader:
+            message = json.loads(line)
+            if "stream" in message:
+                stream = sys.stdout if message["stream"] == "stdout" else sys.stderr
+                stream.write(message["text"])
+                stream.flush()
+            elif "error" in message:
+                utils.printc("Error: " + message["error"], message["color"])
+                return True
+            elif message.get("done"):
+                return True
+    utils.printc("Error: the daemon closed the connection", "red")
+    return True
+
+
+def stop(root: pathlib.Path = pathlib.Path(".")):
+    if not request(root, "stop"):
+        raise models.ImgitError("No daemon is running")
+    print("Daemon stopped")
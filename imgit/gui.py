@@ -1,60 +1,324 @@
+import collections
 import http.server
+import dataclasses
 import datetime
+import email.utils
+import json
 import os
 import pathlib
+import re
+import sys
+import threading
 import urllib.parse
 
 import jinja2
 
-from .models import Album, Index
+from .models import Album, Image, Index, IMGIT_FOLDER
+from .storage import INDEX_NAME, open_store
+from .thumbnails import ThumbnailCache
+
+
+PAGE_SIZE = 60
+MAX_PAGE_SIZE = 500
+EVENTS_KEEPALIVE = 15 # seconds
+EVENTS_HISTORY = 100
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Return the first and last byte of a single byte range header, or None
+    when it is not a single byte range, which is then ignored. Raise
+    RangeNotSatisfiable when the range is outside of the file.
+    """
+    m = RANGE_PATTERN.fullmatch(header.strip())
+    if m is None or not (m.group(1) or m.group(2)):
+        return None
+    if not m.group(1):
+        # Suffix range, the last bytes of the file
+        length = int(m.group(2))
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    first = int(m.group(1))
+    if m.group(2) and int(m.group(2)) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    last = size - 1 if not m.group(2) else min(int(m.group(2)), size - 1)
+    return first, last
+
+
+def image_to_json(image: Image) -> dict:
+    return {**dataclasses.asdict(image), "video": image.video}
+
+
+class IndexMonitor(threading.Thread):
+    """Poll the index database of the album and, when another imgit process
+    changed it, reload the index and record which images changed, for the
+    pages to update them.
+    """
+
+    def __init__(self, server: "GuiServer", interval: float = 1):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.interval = interval
+        self.version = 0
+        self.changes: collections.deque[tuple[int, dict]] = collections.deque(maxlen=EVENTS_HISTORY)
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self._signature = self.signature()
+
+    def signature(self) -> tuple:
+        """Sizes and mtimes of the database files, that change on every commit.
+        """
+        folder = self.server.root / IMGIT_FOLDER
+        signature = []
+        for name in [INDEX_NAME, INDEX_NAME + "-wal"]:
+            try:
+                stat = (folder / name).stat()
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            signature = self.signature()
+            if signature != self._signature:
+                self._signature = signature
+                self.reload()
+
+    def reload(self):
+        index = open_store(self.server.root).load()
+        previous, _ = self.server.snapshot()
+        updated = [image for path, image in index.items() if previous.get(path) != image]
+        removed = [path for path in previous if path not in index]
+        if not updated and not removed:
+            return
+        self.server.set_index(index)
+        for image in updated:
+            if self.server.thumbnails.has_thumbnail(image):
+                self.server.thumbnails.submit(image)
+        with self.condition:
+            self.version += 1
+            self.changes.append((self.version, {
+                "total": len(index),
+                "images": [image_to_json(image) for image in sorted(updated, key=lambda image: image.path)],
+                "removed": sorted(removed),
+            }))
+            self.condition.notify_all()
+
+    def wait(self, version: int, timeout: float) -> tuple[int, list[dict] | None]:
+        """Wait for changes newer than version. Return the latest version and
+        the changes, or None if some of them were dropped from the history.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > version or self.stopped.is_set(), timeout)
+            if self.changes and self.changes[0][0] > version + 1:
+                return self.version, None
+            return self.version, [change for change_version, change in self.changes if change_version > version]
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+
+def guess_mime_type(path: pathlib.Path) -> str:
+    ext = path.suffix.lower()
+    if ext in [".jpg", ".jpeg"]:
+        return "image/jpeg"
+    elif ext == ".png":
+        return "image/png"
+    elif ext == ".gif":
+        return "image/gif"
+    elif ext == ".mp4":
+        return "video/mp4"
+    return "application/octet-stream"
 
 
 class GuiRequestHandler(http.server.BaseHTTPRequestHandler):
 
     server: "GuiServer"
+    protocol_version = "HTTP/1.1"
 
     @property
     def location(self):
         return self.path.split("?")[0]
 
-    def error(self, code: int, message: str):
+    def send_body(self, code: int, content_type: str, body: bytes):
         self.send_response(code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def error(self, code: int, message: str):
+        self.send_body(code, "text/plain", message.encode("utf8"))
+
+    def not_modified(self, etag: str, mtime: float) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def send_file(self, path: pathlib.Path, mime_type: str, etag: str | None = None, cache_control: str = "no-cache"):
+        """Stream a file with sendfile, answering conditional requests with
+        304 and range requests with 206, so that videos can be seeked.
+        """
+        try:
+            file = open(path, "rb")
+        except OSError:
+            self.error(404, "Not Found")
+            return
+        with file:
+            stat = os.fstat(file.fileno())
+            if etag is None:
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.send_header("Cache-Control", cache_control)
+                self.end_headers()
+                return
+            first, last = 0, stat.st_size - 1
+            code = 200
+            range_header = self.headers.get("Range")
+            if range_header is not None and self.headers.get("If-Range", etag) in [etag, last_modified]:
+                try:
+                    byte_range = parse_range(range_header, stat.st_size)
+                except RangeNotSatisfiable:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                # Other kinds of ranges are ignored, the whole file is sent
+                if byte_range is not None:
+                    first, last = byte_range
+                    code = 206
+            self.send_response(code)
+            self.send_header("Content-type", mime_type)
+            self.send_header("Content-Length", str(last - first + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", cache_control)
+            if code == 206:
+                self.send_header("Content-Range", f"bytes {first}-{last}/{stat.st_size}")
+            self.end_headers()
+            if self.command == "HEAD" or last < first:
+                return
+            try:
+                self.connection.sendfile(file, first, last - first + 1)
+            except (BrokenPipeError, ConnectionResetError):
+                # The browser gave up on the response, as it does when seeking
+                self.close_connection = True
+
+    def media_path(self, relative: str) -> pathlib.Path | None:
+        path = (self.server.root / relative).resolve()
+        if not path.is_relative_to(self.server.root.resolve()) or not path.is_file():
+            return None
+        return path
+
+    def send_json(self, data):
+        self.send_body(200, "application/json", json.dumps(data).encode("utf8"))
+
+    def send_images(self):
+        """Send one page of the index, as JSON, for the gallery to append.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            offset = max(0, int(query.get("offset", ["0"])[0]))
+            limit = min(MAX_PAGE_SIZE, max(1, int(query.get("limit", [str(PAGE_SIZE)])[0])))
+        except ValueError:
+            self.error(400, "Bad Request")
+            return
+        index, paths = self.server.snapshot()
+        self.send_json({
+            "total": len(paths),
+            "offset": offset,
+            "images": [image_to_json(index[path]) for path in paths[offset:offset + limit]]
+        })
+
+    def send_events(self):
+        """Stream the changes of the index as server-sent events, until the
+        browser leaves. A 'reload' event asks the page to start over when it
+        missed too many changes.
+        """
+        monitor = self.server.monitor
+        if monitor is None:
+            self.error(404, "Not Found")
+            return
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
-        self.wfile.write(message.encode("utf8"))
+        self.close_connection = True
+        version = monitor.version
+        while not monitor.stopped.is_set():
+            version, changes = monitor.wait(version, EVENTS_KEEPALIVE)
+            if changes is None:
+                self.wfile.write(b"event: reload\ndata: {}\n\n")
+                return
+            if not changes:
+                self.wfile.write(b": keepalive\n\n")
+            for change in changes:
+                self.wfile.write(f"data: {json.dumps(change)}\n\n".encode("utf8"))
 
     def do_GET(self):
         if self.location == "/":
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            template = self.server.jinja.get_template("template.html")
-            html = template.render()
-            self.wfile.write(html.encode("utf8"))
+            self.send_body(200, "text/html", self.server.page)
+        elif self.location == "/api/images":
+            self.send_images()
+        elif self.location == "/api/events":
+            self.send_events()
+        elif self.location.startswith("/thumbnails/"):
+            image_path = urllib.parse.unquote(self.location[12:])
+            image = self.server.snapshot()[0].get(image_path)
+            if image is None:
+                self.error(404, "Not Found")
+                return
+            thumbnail = self.server.thumbnails.get(image)
+            if thumbnail is None:
+                # No thumbnail for this file, the browser loads the original
+                self.send_response(302)
+                self.send_header("Location", "/media/" + urllib.parse.quote(image_path))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            # Thumbnails are named after the file they are built from, they never change
+            self.send_file(thumbnail, "image/jpeg", f'"{thumbnail.stem}"', "max-age=31536000, immutable")
         elif self.location.startswith("/media/"):
-            path = self.server.root / urllib.parse.unquote(self.location[7:])
-            if not path.exists():
+            image_path = urllib.parse.unquote(self.location[7:])
+            path = self.media_path(image_path)
+            if path is None:
                 self.error(404, "Not Found")
                 return
-            mime_type = "application/octet-stream"
-            ext = path.suffix.lower()
-            if ext in [".jpg", ".jpeg"]:
-                mime_type = "image/jpeg"
-            elif ext == ".png":
-                mime_type = "image/png"
-            elif ext == ".gif":
-                mime_type = "image/gif"
-            elif ext == ".mp4":
-                mime_type = "video/mp4"
-            self.send_response(200)
-            self.send_header("Content-type", mime_type)
-            self.end_headers()
-            with open(path, "rb") as file:
-                self.wfile.write(file.read())
+            etag = None
+            image = self.server.snapshot()[0].get(image_path)
+            if image is not None and image.local_md5 is not None and image.local_mtime == path.stat().st_mtime:
+                etag = f'"{image.local_md5}"'
+            self.send_file(path, guess_mime_type(path), etag)
         else:
-            self.send_response(404)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"404 Not Found")
+            self.error(404, "404 Not Found")
+
+    def do_HEAD(self):
+        self.do_GET()
 
     def log_message(self, format, *args):
         pass
@@ -84,14 +348,21 @@ def fitler_size(size: int) -> str:
     return f"{size / 1024 ** 3:.1f} GB"
 
 
-class GuiServer(http.server.HTTPServer):
+class GuiServer(http.server.ThreadingHTTPServer):
 
-    def __init__(self, host: str, root: pathlib.Path, album: Album, index: Index):
+    def __init__(self, host: str, root: pathlib.Path, album: Album, index: Index, live: bool = False):
         address, port = host.split(":")
-        http.server.HTTPServer.__init__(self, (address, int(port)), GuiRequestHandler)
+        self.thumbnails = ThumbnailCache(root)
+        self.monitor: IndexMonitor | None = None
+        http.server.ThreadingHTTPServer.__init__(self, (address, int(port)), GuiRequestHandler)
         self.root = root
         self.album = album
-        self.index = index
+        self._lock = threading.Lock()
+        self.set_index(index)
+        self.thumbnails.warm(index)
+        if live:
+            self.monitor = IndexMonitor(self)
+            self.monitor.start()
         self.jinja = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
         self.jinja.filters["date"] = filter_date
         self.jinja.filters["datetime"] = filter_datetime
@@ -99,5 +370,31 @@ class GuiServer(http.server.HTTPServer):
         self.jinja.filters["size"] = fitler_size
         self.jinja.globals.update({
             "album": self.album,
-            "index": self.index
+            "page_size": PAGE_SIZE,
+            "live": live,
         })
+        # The page only holds the album details, the images come from the API
+        self.page = self.jinja.get_template("template.html").render().encode("utf8")
+
+    def set_index(self, index: Index):
+        with self._lock:
+            self.index = index
+            self.paths = sorted(index)
+
+    def snapshot(self) -> tuple[Index, list[str]]:
+        """Return the index with its sorted paths, consistent with each other.
+        """
+        with self._lock:
+            return self.index, self.paths
+
+    def handle_error(self, request, client_address):
+        # Browsers drop connections all the time, when seeking a video or
+        # leaving the page
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def server_close(self):
+        http.server.ThreadingHTTPServer.server_close(self)
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.thumbnails.close()
@@ -0,0 +1,135 @@
+import pathlib
+import re
+
+
+def load_ignore_patterns(path: str | pathlib.Path) -> list[str]:
+    with open(path, "r", encoding="utf8") as file:
+        patterns = [
+            line.strip()
+            for line in file
+            if line.strip() and not line.startswith('#')
+        ]
+    return patterns
+
+
+def translate(pattern: str) -> str:
+    """Translate a gitignore glob into a regular expression body, where
+    wildcards do not cross slashes and ** spans any number of folders.
+    """
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            j = pattern.index("]", i + 2)
+            content = pattern[i + 1:j].replace("\\", "\\\\")
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            parts.append(f"[{content}]")
+            i = j + 1
+        elif pattern[i] == "\\" and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts)
+
+
+class RuleSet:
+    """Rules compiled into one regular expression per kind of path. The
+    alternatives are in reverse order, so the first alternative that matches is
+    the last matching rule.
+    """
+
+    def __init__(self):
+        self.file_alternatives: list[str] = []
+        self.folder_alternatives: list[str] = []
+        self.file_regex: re.Pattern | None = None
+        self.folder_regex: re.Pattern | None = None
+
+    def add(self, index: int, body: str, folder_only: bool):
+        alternative = f"(?P<r{index}>{body})"
+        self.folder_alternatives.insert(0, alternative)
+        if not folder_only:
+            self.file_alternatives.insert(0, alternative)
+
+    def compile(self):
+        if self.file_alternatives:
+            self.file_regex = re.compile("|".join(self.file_alternatives))
+        if self.folder_alternatives:
+            self.folder_regex = re.compile("|".join(self.folder_alternatives))
+
+    def search(self, subject: str, folder: bool) -> int:
+        regex = self.folder_regex if folder else self.file_regex
+        if regex is None:
+            return -1
+        m = regex.fullmatch(subject)
+        return -1 if m is None else int(m.lastgroup[1:])
+
+
+class IgnoreRules:
+    """Patterns of an .imgitignore file, with gitignore semantics: the last
+    matching pattern wins, ! negates, a trailing / only matches folders and a
+    slash anywhere else anchors the pattern to the root.
+
+    Patterns without a slash are matched against the basename. Anchored
+    patterns starting with a literal folder name are grouped by that name, so
+    that a path is only tried against the patterns of its first folder plus
+    the few that start with a wildcard.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.negations: list[bool] = []
+        self.basename_rules = RuleSet()
+        self.generic_rules = RuleSet()
+        self.segment_rules: dict[str, RuleSet] = {}
+        for index, pattern in enumerate(patterns):
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+                pattern = pattern[1:]
+            self.negations.append(negate)
+            folder_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            if "/" not in pattern:
+                self.basename_rules.add(index, translate(pattern), folder_only)
+                continue
+            pattern = pattern.lstrip("/")
+            segment = pattern.split("/", 1)[0]
+            if any(char in segment for char in "*?[\\"):
+                self.generic_rules.add(index, translate(pattern), folder_only)
+            else:
+                self.segment_rules.setdefault(segment, RuleSet()).add(index, translate(pattern), folder_only)
+        for ruleset in [self.basename_rules, self.generic_rules, *self.segment_rules.values()]:
+            ruleset.compile()
+
+    @classmethod
+    def from_file(cls, path: str | pathlib.Path):
+        return cls(load_ignore_patterns(path))
+
+    def match(self, path: str, folder: bool = False) -> bool:
+        """Tell whether a path, relative to the root and with forward slashes,
+        is ignored.
+        """
+        index = max(
+            self.basename_rules.search(path.rsplit("/", 1)[-1], folder),
+            self.generic_rules.search(path, folder))
+        ruleset = self.segment_rules.get(path.split("/", 1)[0])
+        if ruleset is not None:
+            index = max(index, ruleset.search(path, folder))
+        return index >= 0 and not self.negations[index]
@@ -0,0 +1,97 @@
+import json
+import os
+import pathlib
+import threading
+import time
+
+from . import models
+from . import profiling
+
+
+JOURNAL_NAME = "journal.jsonl"
+
+
+class Journal:
+    """Write-ahead log of the remote operations planned by an action.
+
+    Each operation is appended when planned, when it starts and when it is
+    done, and the file is synced to disk every time. Operations that are not
+    done when the action stops are what `imgit resume` replays.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.path = root / models.IMGIT_FOLDER / JOURNAL_NAME
+        self._lock = threading.Lock()
+
+    def _read(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+        entries = []
+        with open(self.path, "r", encoding="utf8") as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Last line was cut by a crash while being written
+                    break
+        return entries
+
+    def _append(self, entries: list[dict]):
+        with self._lock, profiling.phase("journal write"):
+            with open(self.path, "ab+") as file:
+                if file.tell() > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        # Drop the line a crash cut, entries appended after
+                        # it would be unreadable otherwise
+                        file.seek(0)
+                        file.truncate(file.read().rfind(b"\n") + 1)
+                for entry in entries:
+                    file.write(json.dumps(entry).encode("utf8") + b"\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def plan(self, action: str, operations: list[dict]) -> list[dict]:
+        start = len(self._read())
+        planned = [
+            {"event": "plan", "id": start + i, "action": action, **operation}
+            for i, operation in enumerate(operations)
+        ]
+        self._append(planned)
+        return planned
+
+    def start(self, *operations: dict):
+        """Log that operations are sent, with the time and, for uploads, the
+        size of the file, which tell on resume whether an image found online
+        comes from them.
+        """
+        now = time.time()
+        self._append([
+            {"event": "start", "id": operation["id"], "time": now, "size": operation.get("image", {}).get("local_size")}
+            for operation in operations
+        ])
+
+    def done(self, *operations: dict):
+        self._append([{"event": "done", "id": operation["id"]} for operation in operations])
+
+    def pending(self) -> list[dict]:
+        """Return the planned operations that are not done, with a 'started'
+        key telling whether they might have reached Imgur, and for those, the
+        time they were first started at and the size of the file they sent.
+        """
+        operations: dict[int, dict] = {}
+        for entry in self._read():
+            if entry["event"] == "plan":
+                operations[entry["id"]] = {**entry, "started": False}
+            elif entry["event"] == "start" and entry["id"] in operations:
+                operation = operations[entry["id"]]
+                if not operation["started"]:
+                    operation["started_at"] = entry.get("time")
+                    operation["started_size"] = entry.get("size")
+                operation["started"] = True
+            elif entry["event"] == "done":
+                operations.pop(entry["id"], None)
+        return list(operations.values())
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
@@ -4,6 +4,7 @@ import os
 
 IMGIT_FOLDER = ".imgit"
 IGNORE_NAME = ".imgitignore"
+API_URL = "https://api.imgur.com"
 NON_ANIMATED_IMAGES = [".jpg", ".jpeg", ".png", ".tiff"]
 VIDEOS = [".mp4", ".mpeg", ".avi", ".webm"]
 ANIMATED_IMAGES = VIDEOS + [".gif", ".apng"]
@@ -21,6 +22,10 @@ class QuotaError(ImgurError):
     pass
 
 
+class NotFoundError(ImgurError):
+    pass
+
+
 class ImgitError(Exception):
     pass
 
@@ -33,6 +38,7 @@ class Album:
     description: str
     datetime: int
     link: str
+    images_count: int | None = None
 
 
 @dataclasses.dataclass
@@ -47,6 +53,8 @@ class Image:
     local_ctime: float | None
     local_mtime: float | None
     local_md5: str | None
+    local_inode: int | None = None
+    local_hash_algorithm: str | None = None
     
     @property
     def online(self) -> bool:
@@ -65,6 +73,19 @@ class Image:
         return os.path.splitext(self.path)[1].lower() in VIDEOS
 
 
+class ContentIndex(dict[tuple[str | None, str], list[tuple[str, Image]]]):
+    """Online images of one or several albums, by local content hash. Values
+    are pairs of album id and image.
+    """
+
+    def add(self, album_id: str, image: Image):
+        if image.online and image.local_md5 is not None:
+            self.setdefault((image.local_hash_algorithm, image.local_md5), []).append((album_id, image))
+
+    def find(self, image: Image) -> list[tuple[str, Image]]:
+        return self.get((image.local_hash_algorithm, image.local_md5), [])
+
+
 class Index(dict[str, Image]):
 
     def add(self, image: Image):
@@ -75,4 +96,24 @@ class Index(dict[str, Image]):
         index = cls()
         for image in images:
             index.add(image)
-        return index
\ No newline at end of file
+        return index
+
+
+@dataclasses.dataclass
+class Plan:
+    """Differences between the index and the local folder, computed once and
+    shared by the actions of a command.
+    """
+    album: Album
+    index: Index
+    local_index: Index
+    download: list[Image] = dataclasses.field(default_factory=list)
+    link: list[Image] = dataclasses.field(default_factory=list)
+    upload: list[Image] = dataclasses.field(default_factory=list)
+    change: list[Image] = dataclasses.field(default_factory=list)
+    delete: list[Image] = dataclasses.field(default_factory=list)
+    rename: list[tuple[Image, Image]] = dataclasses.field(default_factory=list)
+
+    @property
+    def up_to_date(self) -> bool:
+        return not (self.download or self.link or self.upload or self.change or self.delete or self.rename)
@@ -0,0 +1,98 @@
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+
+class Profiler:
+    """Timers and counters of the phases of an action, enabled with the
+    --profile flag. When disabled, a phase costs a single flag check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers: dict[str, list[float]] = {}
+        self.counters: dict[str, int] = {}
+        self.events: list[tuple[str, float, float, int]] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def record(self, name: str, start: float, duration: float):
+        """Add a timed event, start being a time.perf_counter() value.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0])
+            timer[0] += duration
+            timer[1] += 1
+            self.events.append((name, start, duration, threading.get_ident()))
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self) -> str:
+        """Table of the timers, slowest first, then of the counters. Phases may
+        nest, and run concurrently, so their times do not add up.
+        """
+        total = time.perf_counter() - self._origin
+        width = max([len(name) for name in [*self.timers, *self.counters]] + [len("Phase")])
+        lines = [f"{'Phase':<{width}}  {'Calls':>7}  {'Total':>9}  {'Mean':>9}  {'%':>5}"]
+        for name, (seconds, calls) in sorted(self.timers.items(), key=lambda item: -item[1][0]):
+            lines.append(f"{name:<{width}}  {calls:>7}  {seconds:>8.3f}s  {seconds / calls * 1000:>7.1f}ms  {100 * seconds / total:>5.1f}")
+        lines.append(f"{'total':<{width}}  {'':>7}  {total:>8.3f}s")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<{width}}  {value:>7}" if not name.startswith("bytes") else f"{name:<{width}}  {format_bytes(value):>7}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str | pathlib.Path):
+        """Write the events in the Chrome trace format, that chrome://tracing
+        and Perfetto open.
+        """
+        with self._lock:
+            trace = {
+                "traceEvents": [
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": duration * 1e6,
+                        "pid": os.getpid(),
+                        "tid": thread,
+                    }
+                    for name, start, duration, thread in self.events
+                ],
+                "counters": self.counters,
+            }
+        with open(path, "w", encoding="utf8") as file:
+            json.dump(trace, file)
+
+
+def format_bytes(size: int) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+PROFILER = Profiler()
+phase = PROFILER.phase
+record = PROFILER.record
+count = PROFILER.count
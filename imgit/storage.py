@@ -0,0 +1,126 @@
+import dataclasses
+import os
+import pathlib
+import sqlite3
+import threading
+
+from . import models
+from . import profiling
+from . import utils
+
+
+INDEX_NAME = "index.db"
+LEGACY_INDEX_NAME = "index.json"
+
+
+class IndexStore:
+    """SQLite storage for the index, with one row per image, so that saving a
+    checkpoint only writes the rows that changed.
+
+    Long running processes can keep the rows in memory with keep_in_memory,
+    then loading the index does not query the database unless another process
+    wrote to it.
+    """
+
+    FIELDS = [field.name for field in dataclasses.fields(models.Image)]
+
+    def __init__(self, path: str | pathlib.Path):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY)")
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(images)")}
+        for field in self.FIELDS:
+            if field not in columns:
+                self.connection.execute(f"ALTER TABLE images ADD COLUMN {field}")
+        self.connection.commit()
+        self._upsert_query = f"INSERT OR REPLACE INTO images ({', '.join(self.FIELDS)}) VALUES ({', '.join('?' * len(self.FIELDS))})"
+        self._rows: dict[str, tuple] | None = None
+        self._rows_version: int | None = None
+        self.in_memory = False
+
+    def _row(self, image: models.Image) -> tuple:
+        return tuple(getattr(image, field) for field in self.FIELDS)
+
+    def keep_in_memory(self):
+        with self._lock:
+            self.in_memory = True
+
+    def _data_version(self) -> int:
+        # Changes when another connection commits, not on our own commits
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self) -> models.Index:
+        with self._lock, profiling.phase("index load"):
+            if self.in_memory:
+                version = self._data_version()
+                if self._rows is None or version != self._rows_version:
+                    cursor = self.connection.execute(f"SELECT {', '.join(self.FIELDS)} FROM images")
+                    self._rows = {row[0]: row for row in cursor}
+                    self._rows_version = version
+                rows = self._rows.values()
+            else:
+                rows = self.connection.execute(f"SELECT {', '.join(self.FIELDS)} FROM images")
+            return models.Index.from_list([models.Image(*row) for row in rows])
+
+    def upsert(self, images: list[models.Image]):
+        with self._lock, profiling.phase("index write"), self.connection:
+            rows = [self._row(image) for image in images]
+            self.connection.executemany(self._upsert_query, rows)
+            if self._rows is not None:
+                self._rows.update((row[0], row) for row in rows)
+
+    def delete(self, paths: list[str]):
+        with self._lock, profiling.phase("index write"), self.connection:
+            self.connection.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in paths])
+            if self._rows is not None:
+                for path in paths:
+                    self._rows.pop(path, None)
+
+    def save(self, index: models.Index):
+        with self._lock, profiling.phase("index save"), self.connection:
+            stored = {row[0] for row in self.connection.execute("SELECT path FROM images")}
+            rows = [self._row(image) for image in index.values()]
+            self.connection.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in stored - index.keys()])
+            self.connection.executemany(self._upsert_query, rows)
+            if self._rows is not None:
+                self._rows = {row[0]: row for row in rows}
+
+    def close(self):
+        """Close the connection, the next open_store of the folder opens a new
+        one.
+        """
+        with _stores_lock:
+            for key, store in list(_stores.items()):
+                if store is self:
+                    del _stores[key]
+        with self._lock:
+            self.connection.close()
+
+
+_stores: dict[pathlib.Path, IndexStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(root: pathlib.Path) -> IndexStore:
+    """Return the index store of an imgit folder, opened once per process. An
+    index.json left by older versions is imported then renamed to
+    index.json.bak.
+    """
+    folder = root / models.IMGIT_FOLDER
+    if not folder.exists():
+        raise models.ImgitError("Not an imgit folder")
+    key = folder.resolve()
+    with _stores_lock:
+        if key not in _stores:
+            legacy_path = folder / LEGACY_INDEX_NAME
+            migrate = legacy_path.exists() and not (folder / INDEX_NAME).exists()
+            store = IndexStore(folder / INDEX_NAME)
+            if migrate:
+                images = utils.read_dataclass_list(models.Image, legacy_path)
+                store.save(models.Index.from_list(images))
+                os.replace(legacy_path, legacy_path.with_name(LEGACY_INDEX_NAME + ".bak"))
+            _stores[key] = store
+        return _stores[key]
@@ -0,0 +1,117 @@
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import threading
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+from . import models
+from . import utils
+
+
+THUMBNAILS_FOLDER = "thumbnails"
+THUMBNAIL_SIZE = 400 # pixels
+
+
+def thumbnail_key(image: models.Image, mtime: float | None, size: int | None) -> str:
+    """Name of the thumbnail of an image. It derives from the content hash and
+    from the mtime and size of the file on disk, which the thumbnail is built
+    from, so a file modified since it was indexed gets a new thumbnail instead
+    of a stale one.
+    """
+    stamp = f"{mtime}:{size}"
+    if image.local_md5 is not None:
+        algorithm = image.local_hash_algorithm or utils.LEGACY_HASH_ALGORITHM
+        return f"{algorithm}-{image.local_md5}-" + hashlib.md5(stamp.encode("utf8")).hexdigest()[:8]
+    source = f"{image.path}:{stamp}"
+    return "path-" + hashlib.md5(source.encode("utf8")).hexdigest()
+
+
+class ThumbnailCache:
+    """JPEG thumbnails of the local images, stored under .imgit/thumbnails and
+    generated by a background pool. Without Pillow, or for videos, there is no
+    thumbnail and callers fall back to the original file.
+    """
+
+    def __init__(self, root: pathlib.Path, jobs: int = 2, size: int = THUMBNAIL_SIZE):
+        self.root = root
+        self.folder = root / models.IMGIT_FOLDER / THUMBNAILS_FOLDER
+        self.size = size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._scheduled: set[str] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return PIL is not None
+
+    def path(self, image: models.Image) -> pathlib.Path:
+        try:
+            stat = (self.root / image.path).stat()
+            key = thumbnail_key(image, stat.st_mtime, stat.st_size)
+        except OSError:
+            key = thumbnail_key(image, image.local_mtime, image.local_size)
+        return self.folder / (key + ".jpg")
+
+    def _generate(self, image: models.Image, path: pathlib.Path) -> pathlib.Path | None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.part")
+        try:
+            with PIL.Image.open(self.root / image.path) as source:
+                thumbnail = PIL.ImageOps.exif_transpose(source)
+                thumbnail.thumbnail((self.size, self.size))
+                thumbnail.convert("RGB").save(tmp_path, "JPEG", quality=80)
+        except (OSError, ValueError):
+            tmp_path.unlink(missing_ok=True)
+            return None
+        os.replace(tmp_path, path)
+        return path
+
+    def has_thumbnail(self, image: models.Image) -> bool:
+        return self.enabled and image.offline and not image.video
+
+    def submit(self, image: models.Image):
+        """Schedule the generation of a thumbnail in the background, unless it
+        is cached or already scheduled.
+        """
+        path = self.path(image)
+        with self._lock:
+            if path.name in self._scheduled or path.exists():
+                return
+            self._scheduled.add(path.name)
+        self.executor.submit(self._generate, image, path)
+
+    def get(self, image: models.Image) -> pathlib.Path | None:
+        """Return the thumbnail of an image. A thumbnail the background pool
+        did not reach yet is generated right away, as it is being looked at.
+        """
+        if not self.has_thumbnail(image):
+            return None
+        path = self.path(image)
+        if path.exists():
+            return path
+        return self._generate(image, path)
+
+    def warm(self, index: models.Index):
+        """Generate missing thumbnails in the background, and delete the ones
+        that no image of the index uses anymore.
+        """
+        if not self.enabled:
+            return
+        used = set()
+        for image in sorted(index.values(), key=lambda image: image.path):
+            if self.has_thumbnail(image):
+                used.add(self.path(image).name)
+                self.submit(image)
+        if self.folder.exists():
+            for path in self.folder.iterdir():
+                if path.name not in used and path.suffix == ".jpg":
+                    path.unlink(missing_ok=True)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
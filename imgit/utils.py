@@ -3,7 +3,19 @@ import hashlib
 import json
 import os
 import pathlib
-import shutil
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+LEGACY_HASH_ALGORITHM = "md5-1k"
+HASH_ALGORITHMS = ["md5", "blake2b"] + (["xxh3"] if xxhash is not None else [])
+# Fixed, rather than xxh3 when installed, so that an index can be read
+# wherever imgit runs. xxh3 is opt-in through --hash.
+DEFAULT_HASH_ALGORITHM = "blake2b"
+HASH_BUFFER_SIZE = 1024 * 1024 # bytes
 
 
 class bcolors:
@@ -72,21 +84,83 @@ def write_dataclass_list(obj, path: str | pathlib.Path):
         json.dump([dataclasses.asdict(o) for o in obj], file, indent=4, default=str)
 
 
-def hash_file(path: str | pathlib.Path, size: int = 1024) -> str:
-    md5 = hashlib.md5()
-    with open(path, "rb") as file:
-        data = file.read(size)
-        md5.update(data)
-    return md5.hexdigest()
+def new_hasher(algorithm: str):
+    if algorithm == "md5":
+        return hashlib.md5()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown hash algorithm {algorithm}")
+
+
+def is_hash_available(algorithm: str) -> bool:
+    return algorithm in HASH_ALGORITHMS or algorithm == LEGACY_HASH_ALGORITHM
+
+
+def hash_file(path: str | pathlib.Path, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    if algorithm == LEGACY_HASH_ALGORITHM:
+        with open(path, "rb") as file:
+            return hashlib.md5(file.read(1024)).hexdigest()
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while size := file.readinto(buffer):
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
+def hash_files(paths: list[pathlib.Path], algorithm: str = DEFAULT_HASH_ALGORITHM, jobs: int | None = None, missing_ok: bool = False) -> list[str | None]:
+    """Hash files concurrently, hashlib releases the GIL on large updates so
+    threads are enough to keep several disks and cores busy. With missing_ok,
+    files that vanished get None instead of raising.
+    """
+    def hash_path(path: pathlib.Path) -> str | None:
+        try:
+            return hash_file(path, algorithm)
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
+            return None
+    if len(paths) <= 1 or jobs == 1:
+        return [hash_path(path) for path in paths]
+    # Imported here as it pulls logging in, which a cached scan does not need
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(hash_path, paths))
+
+
+def run_concurrently(function, items: list, jobs: int = 1):
+    """Call function on every item using at most jobs threads. The first
+    exception cancels the items that did not start yet, and is raised once the
+    running ones are over.
+    """
+    if jobs <= 1:
+        for item in items:
+            function(item)
+        return
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(function, item) for item in items]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
 
 def remove_empty_directories(root: pathlib.Path):
-    while True:
-        deleted = False
-        for top, dirs, files in os.walk(root):
-            if not files:
-                shutil.rmtree(root / top)
-                deleted = True
-                break
-        if not deleted:
-            break
+    """Remove the folders below root that hold no file, in a single bottom-up
+    walk. Root itself is kept.
+    """
+    for top, dirs, files in os.walk(root, topdown=False):
+        if files or pathlib.Path(top) == pathlib.Path(root):
+            continue
+        try:
+            os.rmdir(top)
+        except OSError:
+            # Not empty, one of its subfolders holds files
+            pass
@@ -0,0 +1,167 @@
+import abc
+import dataclasses
+import os
+import pathlib
+import threading
+
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+from . import models
+
+
+@dataclasses.dataclass
+class Changes:
+    paths: set[str] = dataclasses.field(default_factory=set)
+    moves: list[tuple[str, str]] = dataclasses.field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.paths or self.moves)
+
+
+class Watcher(abc.ABC):
+    """Collect the paths, relative to root, that changed in a folder. Changes
+    are gathered by a background thread and handed out in debounced batches.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root.absolute()
+        self._changes = Changes()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def relative(self, path: str | bytes) -> str | None:
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        relpath = pathlib.Path(path).relative_to(self.root).as_posix()
+        if relpath == "." or relpath.split("/")[0] == models.IMGIT_FOLDER:
+            return None
+        return relpath
+
+    def record(self, path: str | bytes):
+        relpath = self.relative(path)
+        if relpath is None:
+            return
+        with self._lock:
+            self._changes.paths.add(relpath)
+        self._event.set()
+
+    def record_move(self, src: str | bytes, dst: str | bytes):
+        src_relpath, dst_relpath = self.relative(src), self.relative(dst)
+        if src_relpath is None or dst_relpath is None:
+            self.record(src)
+            self.record(dst)
+            return
+        with self._lock:
+            self._changes.moves.append((src_relpath, dst_relpath))
+        self._event.set()
+
+    def wait(self, timeout: float | None = None, debounce: float = 2) -> Changes:
+        """Block until something changes or timeout expires, then wait for
+        debounce seconds without any new change and return everything that
+        changed meanwhile.
+        """
+        if not self._event.wait(timeout):
+            return Changes()
+        while True:
+            self._event.clear()
+            if not self._event.wait(debounce):
+                break
+        with self._lock:
+            changes = self._changes
+            self._changes = Changes()
+        return changes
+
+    @abc.abstractmethod
+    def start(self):
+        pass
+
+    @abc.abstractmethod
+    def stop(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    """Fallback that compares the size and mtime of every file at a fixed
+    interval.
+    """
+
+    def __init__(self, root: pathlib.Path, interval: float = 5):
+        Watcher.__init__(self, root)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def snapshot(self) -> dict[str, tuple[int, float]]:
+        snapshot = {}
+        for folder, dirnames, filenames in os.walk(self.root):
+            if folder == str(self.root) and models.IMGIT_FOLDER in dirnames:
+                dirnames.remove(models.IMGIT_FOLDER)
+            for filename in filenames:
+                path = os.path.join(folder, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def _run(self):
+        previous = self.snapshot()
+        while not self._stop.wait(self.interval):
+            current = self.snapshot()
+            for path in previous.keys() | current.keys():
+                if previous.get(path) != current.get(path):
+                    self.record(path)
+            previous = current
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+if watchdog is not None:
+
+    class EventHandler(watchdog.events.FileSystemEventHandler):
+
+        def __init__(self, watcher: "EventWatcher"):
+            self.watcher = watcher
+
+        def on_any_event(self, event: watchdog.events.FileSystemEvent):
+            if event.event_type == "moved":
+                self.watcher.record_move(event.src_path, event.dest_path)
+            elif event.event_type == "modified" and event.is_directory:
+                # Parent folders get this for every change inside them
+                return
+            elif event.event_type in ["created", "modified", "deleted", "closed"]:
+                self.watcher.record(event.src_path)
+
+
+class EventWatcher(Watcher):
+    """Watcher driven by the filesystem events of the OS (inotify on Linux),
+    through the optional watchdog package.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        Watcher.__init__(self, root)
+        self._observer = watchdog.observers.Observer()
+        self._observer.schedule(EventHandler(self), str(self.root), recursive=True)
+
+    def start(self):
+        self._observer.start()
+
+    def stop(self):
+        self._observer.stop()
+        self._observer.join()
+
+
+def create_watcher(root: pathlib.Path, poll: bool = False, poll_interval: float = 5) -> Watcher:
+    if watchdog is None or poll:
+        return PollingWatcher(root, poll_interval)
+    return EventWatcher(root)
@@ -20,6 +20,7 @@ setup(
     author_email='yohan@chalier.fr',
     install_requires=[
         "requests",
-        "tqdm"
+        "tqdm",
+        "urllib3>=2"
     ],
 )
\ No newline at end of file